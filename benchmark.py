@@ -0,0 +1,1330 @@
+#!/usr/local/bin/python3
+
+from argparse import ArgumentParser as ArgParser
+
+import io
+import os
+import ast
+import sys
+import json
+import time
+import hashlib
+import inspect
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+
+from array import array
+
+import nbfind
+import nbclient
+import pydebug
+import pyparser
+import pynotebook
+import pysource
+import nbconvert
+
+
+class StackParser(pyparser.Parser):
+    '''
+    Parser that looks up the element key with inspect.stack() on every
+    visit and push call, like the parser did before the dispatch table
+    '''
+
+    @property
+    def key(self):
+        call = inspect.stack()[2][3]
+        return call.replace('visit_', '').lower()
+
+    @key.setter
+    def key(self, value):
+        pass
+
+
+class NameParser(pyparser.Parser):
+    '''
+    Parser that looks up the visitor by node type name on every visit, like
+    the parser did before the node type table
+    '''
+
+    def visit(self, node):
+        name = node.__class__.__name__
+        method = getattr(self, 'visit_' + self.ALIASES.get(name, name), None)
+
+        outer = self.key
+        if method is None:
+            (method, self.key) = (self.generic_visit, None)
+        else:
+            self.key = method.__name__.replace('visit_', '').lower()
+
+        try:
+            return method(node)
+        finally:
+            self.key = outer
+
+
+class RecursiveParser(pyparser.Parser):
+    '''
+    Parser that tags the statements with a recursive walk, one python frame
+    per nested block, like segment() did before the explicit stack
+    '''
+
+    def segment(self, tree):
+        context = self.context
+        tags = context.tags
+        classes = context.classes
+        funcs = context.funcs
+
+        marks = []
+
+        def walk(body, in_class, in_func):
+            for node in body:
+                start = node.lineno - 1
+                end = node.end_lineno
+
+                kind = type(node)
+                tag = pyparser.TAG_LINE | pyparser.STATEMENT_TAGS.get(kind, 0)
+
+                if kind is ast.Expr and isinstance(node.value, ast.Constant) and \
+                        isinstance(node.value.value, str):
+                    tag = 0
+
+                enter = 0
+                exit = 0
+                nested_class = in_class
+                nested_func = in_func
+
+                if kind is ast.ClassDef:
+                    nested_class += 1
+                    if not in_func:
+                        (enter, exit) = (pyparser.CLASS_ENTER, pyparser.CLASS_EXIT)
+                elif kind is ast.FunctionDef or kind is ast.AsyncFunctionDef:
+                    nested_func += 1
+                    if not in_func:
+                        (enter, exit) = (pyparser.FUNC_ENTER, pyparser.FUNC_EXIT)
+
+                if enter:
+                    for decorator in node.decorator_list:
+                        start = min(start, decorator.lineno - 1)
+
+                    marks.append((start, enter))
+                    marks.append((end - 1, exit))
+
+                count = end - start
+                tags[start:end] = array('I', [tag]) * count
+                classes[start:end] = array('H', [nested_class]) * count
+                funcs[start:end] = array('H', [nested_func]) * count
+
+                for field in ("body", "orelse", "finalbody", "handlers"):
+                    children = getattr(node, field, None)
+                    if children:
+                        walk(children, nested_class, nested_func)
+
+                for case in getattr(node, "cases", ()):
+                    walk(case.body, nested_class, nested_func)
+
+        walk(tree.body, 0, 0)
+
+        for (lineno, bit) in marks:
+            tags[lineno] |= bit | pyparser.TAG_LINE
+
+
+class FragmentNotebook(pynotebook.Notebook):
+    '''
+    Notebook writer that concatenates escaped JSON fragments line by line,
+    like Notebook.cell did before the structured writer
+    '''
+
+    indent = ' \t'
+
+    def nb_start(self):
+        return '{\t"cells":\n\t[\n'
+
+    def nb_end(self):
+        return ' \t],\n' \
+            ' \t"metadata": {\n' \
+            ' \t\t"anaconda-cloud": {},\n' \
+            ' \t\t"kernelspec": { "display_name": "python3", "language": "python", "name": "python3" },\n' \
+            ' \t\t"language_info": { "codemirror_mode": { \n' \
+            ' \t\t\t"name": "ipython", "version": 3 },\n' \
+            ' \t\t\t"file_extension": ".py",\n' \
+            ' \t\t\t"mimetype": "text/x-python",\n' \
+            ' \t\t\t"name": "python",\n' \
+            ' \t\t\t"nbconvert_exporter": "python",\n' \
+            ' \t\t\t"pygments_lexer": "ipython3",\n' \
+            ' \t\t\t"version": "3.4.2"\n' \
+            ' \t\t\t}\n' \
+            ' \t\t},' \
+            ' \t\t"nbformat": 4, "nbformat_minor": 0\n' \
+            '}'
+
+    def cell(self, change, celltype, line):
+        self.debug(2, "change: %s/%s first: %r line: '%s'",
+                   change, celltype, 1 if self.isfirstcell else 0, line)
+
+        content = ""
+
+        if self.isfirstcell:
+            content = self.nb_start()
+        else:
+            if change:
+                content += "\"\n" + self.indent * 3 + "]\n" + self.indent * 2 + "}"
+            else:
+                content += "\\n\"" 
+            content += ",\n"
+
+        if celltype == "C":
+            typ = "code"
+        elif celltype == "M":
+            typ = "markdown"
+            if line == "":
+                line = " "
+
+        if change:
+            content += self.indent * 2 + \
+                "{" + self.indent + "\"cell_type\": \"" + typ + "\", "
+
+            if typ == "code":
+                content += "\"execution_count\": 2, \"metadata\": { \"collapsed\": false }, \"outputs\": []"
+            else:
+                content += "\"metadata\": {}"
+
+            content += ", \n" + self.indent * 3 + "\"source\": [\n"
+
+        if line is None:
+            content = "\"\n" 
+            content += self.indent * 3 + "]\n" + self.indent * 2 + "}" + "\n"
+            content += self.nb_end()
+        else:
+            line = line.replace('"', '\\\"')
+            content += self.indent * 4 + "\"" + str(line)
+
+        self.debug(2, " %19s line: '%s'", " ", line)
+        #
+        self.isfirstcell = False
+
+        return content
+
+
+def parse_arguments():
+    '''
+    Parse command line arguments
+    '''
+    parser = ArgParser()
+
+    parser.add_argument("files", nargs="*")
+    parser.add_argument('--dir',    action='store', type=str, default="test")
+    parser.add_argument('--repeat', action='store', type=int, default=20)
+    parser.add_argument('--bench',  action='store', default="dispatch",
+                        choices=sorted(BENCHMARKS))
+    parser.add_argument('--json',   action='store', type=str, default="",
+                        help="write the pipeline results to this file")
+
+    # synthetic corpus
+    parser.add_argument('--generate', action='store', type=str, default="",
+                        help="write a synthetic corpus to this directory and exit")
+    parser.add_argument('--modules',  action='store', type=int, default=10)
+    parser.add_argument('--scale',    action='store', type=int, default=1,
+                        help="functions and classes per module in tens")
+    parser.add_argument('--depth',    action='store', type=int, default=4,
+                        help="nesting depth of functions")
+    parser.add_argument('--docstring', action='store', type=int, default=10,
+                        help="lines per docstring")
+
+    # deeply nested inputs
+    parser.add_argument('--stress',   action='store', type=str, default="",
+                        help="write the stress modules to this directory and exit")
+    parser.add_argument('--nesting',  action='store', type=int, default=10000,
+                        help="nesting depth of the stress modules")
+
+    # large generated modules
+    parser.add_argument('--size',     action='store', type=int, default=50,
+                        help="size of the --bench stream module in MB")
+
+    # startup
+    parser.add_argument('--budget',   action='store', type=float, default=60.0,
+                        help="fail if a startup path spends more ms importing (default 60)")
+
+    return parser.parse_args()
+
+
+def docstring(indent, title, lines):
+    '''
+    Return a docstring of <lines> lines
+    '''
+    code = [indent + '"""', indent + title, ""]
+    code += [indent + "Line %d of the description of %s." % (idx, title) for idx in range(lines)]
+    code += [indent + '"""']
+
+    return code
+
+
+def nested(indent, name, depth):
+    '''
+    Return a function with <depth> levels of nested functions
+    '''
+    code = [indent + "def %s(value):" % name]
+
+    if depth > 0:
+        code += nested(indent + "    ", name + "_inner", depth - 1)
+        code += [indent + "    return %s_inner(value) + 1" % name]
+    else:
+        code += [indent + "    return value"]
+
+    return code
+
+
+def generate_module(index, opts):
+    '''
+    Return the source of a synthetic module: imports, comprehension heavy
+    functions, classes with methods, nested functions and docstrings
+    '''
+    code = docstring("", "Generated module %d" % index, opts.docstring)
+    code += ["", "import os", "import sys", "from collections import OrderedDict", ""]
+
+    for idx in range(opts.scale * 10):
+        code += [""]
+        code += ["CONSTANT_%d = [x * %d for x in range(10) if x %% 2]" % (idx, idx)]
+        code += [""]
+        code += ["def function_%d(a, b=1, *args, **kwargs):" % idx]
+        code += docstring("    ", "function_%d" % idx, opts.docstring)
+        code += [
+            "    total = sum(v for v in args if v)",
+            "    mapping = {str(k): [j for j in range(k) if j % 3] for k in range(a)}",
+            "    if a > b:",
+            "        return total",
+            "    elif a == b:",
+            "        return -total",
+            "    else:",
+            "        return total + len(mapping)",
+        ]
+
+    for idx in range(opts.scale * 2):
+        code += ["", ""]
+        code += ["class Class_%d(object):" % idx]
+        code += docstring("    ", "Class_%d" % idx, opts.docstring)
+
+        for method in range(5):
+            code += [""]
+            code += ["    def method_%d(self, value):" % method]
+            code += docstring("        ", "method_%d" % method, opts.docstring // 2)
+            code += nested("        ", "nested", opts.depth)
+            code += ["        return nested(value) + len([v for v in OrderedDict(a=value).values()])"]
+
+    return '\n'.join(code) + '\n'
+
+
+# the serve benchmark fails if a --client run takes more than this share
+# of a cold run
+CLIENT_SHARE = 0.9
+
+# operands of the long concatenation stress module, too deep for the C
+# stack of the main thread under a fixed raised recursion limit
+OPERANDS = 150000
+
+
+def concatenation(operands):
+    '''
+    Return the lines of a string concatenation of <operands> operands
+    '''
+    concat = ["text = 'a'"]
+    for idx in range(1, operands):
+        concat += ["    + 'a'"]
+    concat[1:] = [line + " \\" for line in concat[1:-1]] + concat[-1:]
+    concat[0] += " \\"
+
+    return concat
+
+
+def stress_modules(nesting):
+    '''
+    Return name -> source of modules nested <nesting> levels deep: an elif
+    ladder, a string concatenation and a method call chain, and a
+    concatenation of OPERANDS operands
+    '''
+    # the CPython parser gives up at about 6000 elif branches, the ladder
+    # is then converted from its tokens
+    ladder = ["def classify(value):", "    if value == 0:", "        return 0"]
+    for idx in range(1, nesting):
+        ladder += ["    elif value == %d:" % idx, "        return %d" % idx]
+    ladder += ["    else:", "        return -1"]
+
+    chain = ["builder = (Builder()"]
+    for idx in range(nesting):
+        chain += ["    .add(%d)" % idx]
+    chain += [")"]
+
+    modules = {
+        "2000_elif": ladder,
+        "2001_concat": concatenation(nesting),
+        "2002_chain": chain,
+        "2003_operands": concatenation(OPERANDS),
+    }
+
+    return dict((name, '\n'.join(code) + '\n') for (name, code) in modules.items())
+
+
+def generate_stress(opts):
+    '''
+    Write the deeply nested stress modules to --stress
+    '''
+    os.makedirs(opts.stress, exist_ok=True)
+
+    modules = stress_modules(opts.nesting)
+    for (name, code) in sorted(modules.items()):
+        with open(os.path.join(opts.stress, name + ".py"), 'w') as f:
+            f.write(code)
+
+    print("wrote %d modules to %s" % (len(modules), opts.stress))
+
+
+def generate(opts):
+    '''
+    Write a synthetic corpus of --modules modules to --generate
+    '''
+    os.makedirs(opts.generate, exist_ok=True)
+
+    for index in range(opts.modules):
+        with open(os.path.join(opts.generate, "module_%04d.py" % index), 'w') as f:
+            f.write(generate_module(index, opts))
+
+    print("wrote %d modules to %s" % (opts.modules, opts.generate))
+
+
+def bench_visit(cls, tree, code, repeat):
+    '''
+    Return the best wall time of <repeat> visits of tree
+    '''
+    best = None
+
+    for _ in range(repeat):
+        parser = cls(debuglevel=0)
+        parser.context.code = code
+        parser.context.allocate()
+
+        start = time.perf_counter()
+        parser.visit(tree)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def find_files(opts):
+    '''
+    Return the benchmark input files
+    '''
+    if opts.files != []:
+        return opts.files
+
+    return sorted(os.path.join(opts.dir, fname)
+                  for fname in os.listdir(opts.dir)
+                  if fname[-3:] == '.py')
+
+
+def bench_dispatch(opts, files):
+    '''
+    Compare the per node visit cost of the dispatch table against the
+    inspect.stack() lookup for every file
+    '''
+    print("%-24s %6s %12s %12s %8s" % ("file", "nodes", "stack us/n", "table us/n", "speedup"))
+
+    total_nodes = 0
+    total_stack = 0.0
+    total_table = 0.0
+
+    for fname in files:
+        with open(fname) as f:
+            code = f.read()
+
+        tree = ast.parse(code)
+        code = code.split('\n')
+
+        nodes = sum(1 for _ in ast.walk(tree))
+
+        t_stack = bench_visit(StackParser, tree, code, opts.repeat)
+        t_table = bench_visit(pyparser.Parser, tree, code, opts.repeat)
+
+        total_nodes += nodes
+        total_stack += t_stack
+        total_table += t_table
+
+        print("%-24s %6d %12.2f %12.2f %7.1fx" % (
+            os.path.basename(fname), nodes,
+            t_stack / nodes * 1e6, t_table / nodes * 1e6,
+            t_stack / t_table))
+
+    if total_nodes:
+        print("%-24s %6d %12.2f %12.2f %7.1fx" % (
+            "total", total_nodes,
+            total_stack / total_nodes * 1e6, total_table / total_nodes * 1e6,
+            total_stack / total_table))
+
+
+class Formatted():
+    '''
+    Debug argument that counts how often it is formatted
+    '''
+    count = 0
+
+    def __str__(self):
+        Formatted.count += 1
+        return "formatted"
+
+    __repr__ = __str__
+
+
+def bench_debug(opts, files):
+    '''
+    Check that a debuglevel=0 conversion never formats a debug message and
+    compare a disabled debug call against eager formatting
+    '''
+    emitted = []
+
+    class CountingDebug(pydebug.Debug):
+        def __call__(self, level, line="", *args):
+            if level <= self.debuglevel:
+                emitted.append(level)
+
+    for fname in files:
+        parser = pyparser.Parser(debuglevel=0)
+        parser.debug = CountingDebug(0)
+        parser.parse(fname)
+
+        notebook = pynotebook.Notebook(debuglevel=0)
+        notebook.debug = CountingDebug(0)
+
+        celltype = "C"
+        for line in parser.notebook():
+            if line is None:
+                notebook.cell("1", celltype, line)
+            else:
+                (_lineno, _line, change, celltype) = line
+                notebook.cell(change, celltype, _line)
+
+    print("messages emitted at debuglevel=0: %d" % len(emitted))
+
+    debug = pydebug.Debug(0)
+    arg = Formatted()
+    calls = 100000
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        debug(4, "line: %s %s", arg, arg)
+    lazy = time.perf_counter() - start
+    formatted = Formatted.count
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        "line: %s %s" % (arg, arg)
+    eager = time.perf_counter() - start
+
+    print("arguments formatted by %d disabled calls: %d" % (calls, formatted))
+    print("disabled debug call: %8.3f us" % (lazy / calls * 1e6))
+    print("eager formatting:    %8.3f us" % (eager / calls * 1e6))
+
+    if emitted or formatted:
+        sys.exit(1)
+
+
+def notebook_lines(files):
+    '''
+    Return the Parser.notebook() output of all files
+    '''
+    lines = []
+
+    for fname in files:
+        parser = pyparser.Parser(debuglevel=0)
+        parser.parse(fname)
+
+        lines.extend(line for line in parser.notebook() if line is not None)
+
+    return lines
+
+
+def write_notebook(cls, lines):
+    '''
+    Feed lines to a notebook writer, return the time and the output text
+    '''
+    notebook = cls(debuglevel=0)
+    f_out = io.StringIO()
+
+    start = time.perf_counter()
+    for (_lineno, _line, change, celltype) in lines:
+        f_out.write(notebook.cell(change, celltype, _line))
+    f_out.write(notebook.cell("1", "C", None))
+    elapsed = time.perf_counter() - start
+
+    return elapsed, f_out.getvalue()
+
+
+def bench_notebook(opts, files):
+    '''
+    Compare the throughput of the structured notebook writer against the
+    string fragment writer, on the test/ lines repeated --repeat times
+    '''
+    lines = notebook_lines(files) * opts.repeat
+
+    print("%-10s %8s %12s %10s %6s" % ("writer", "lines", "lines/s", "MB/s", "json"))
+
+    for (name, cls) in [("fragment", FragmentNotebook), ("structured", pynotebook.Notebook)]:
+        elapsed, text = write_notebook(cls, lines)
+
+        try:
+            json.loads(text)
+            valid = "ok"
+        except ValueError:
+            valid = "error"
+
+        print("%-10s %8d %12.0f %10.2f %6s" % (
+            name, len(lines), len(lines) / elapsed, len(text) / elapsed / 1e6, valid))
+
+
+def bench_memory(opts, files):
+    '''
+    Convert all files --repeat times in one process with one parser and
+    check that memory stays flat after the first round
+    '''
+    parser = pyparser.Parser(debuglevel=0)
+    rounds = []
+
+    tracemalloc.start()
+
+    for _ in range(opts.repeat):
+        for fname in files:
+            parser.parse(fname)
+
+            notebook = pynotebook.Notebook(debuglevel=0)
+            for line in parser.notebook():
+                if line is None:
+                    notebook.cell("1", "C", line)
+                else:
+                    (_lineno, _line, change, celltype) = line
+                    notebook.cell(change, celltype, _line)
+
+        rounds.append(tracemalloc.get_traced_memory()[0])
+
+    tracemalloc.stop()
+
+    growth = rounds[-1] - rounds[0]
+
+    print("files per round: %d, rounds: %d" % (len(files), len(rounds)))
+    print("memory after first round: %8d bytes" % rounds[0])
+    print("memory after last round:  %8d bytes" % rounds[-1])
+    print("growth:                   %8d bytes" % growth)
+
+    # allow for allocator and interning noise, not for per file growth
+    if growth > 16 * 1024:
+        sys.exit(1)
+
+
+STAGES = ["read", "ast.parse", "Parser.segment", "Parser.notebook", "Notebook.cell", "write"]
+
+
+def run_pipeline(fname, f_out):
+    '''
+    Convert one file stage by stage, return the time of every stage
+    '''
+    times = []
+    clock = time.perf_counter
+
+    start = clock()
+    source = pysource.Source.read(fname)
+    times.append(clock() - start)
+
+    parser = pyparser.Parser(debuglevel=0)
+    parser.load(source)
+
+    start = clock()
+    tree = parser.syntax_tree()
+    times.append(clock() - start)
+
+    start = clock()
+    parser.segment(tree)
+    times.append(clock() - start)
+
+    start = clock()
+    lines = list(nbconvert.notebook_lines(parser))
+    times.append(clock() - start)
+
+    notebook = pynotebook.Notebook(debuglevel=0)
+
+    start = clock()
+    chunks = [notebook.cell(change, celltype, line) for (change, celltype, line) in lines]
+    times.append(clock() - start)
+
+    start = clock()
+    f_out.seek(0)
+    f_out.write(''.join(chunks))
+    f_out.truncate()
+    f_out.flush()
+    times.append(clock() - start)
+
+    return times
+
+
+def bench_pipeline(opts, files):
+    '''
+    Time every conversion stage over all files, report lines/s, nodes/s
+    and peak memory, and write the results to --json
+    '''
+    lines = 0
+    nodes = 0
+
+    for fname in files:
+        source = pysource.Source.read(fname)
+        lines += len(source.lines)
+        nodes += sum(1 for _ in ast.walk(ast.parse(source.data)))
+
+    best = [None] * len(STAGES)
+
+    with tempfile.TemporaryFile('w+') as f_out:
+        for _ in range(opts.repeat):
+            totals = [0.0] * len(STAGES)
+
+            for fname in files:
+                for (idx, elapsed) in enumerate(run_pipeline(fname, f_out)):
+                    totals[idx] += elapsed
+
+            best = [t if b is None or t < b else b for (t, b) in zip(totals, best)]
+
+        # separate pass, tracing slows down the timed runs
+        tracemalloc.start()
+        for fname in files:
+            run_pipeline(fname, f_out)
+            peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    results = {
+        "version": nbconvert.__version__,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": len(files),
+        "lines": lines,
+        "nodes": nodes,
+        "peak_memory": peak,
+        "stages": {}
+    }
+
+    print("files: %d lines: %d nodes: %d peak memory: %d bytes" % (len(files), lines, nodes, peak))
+    print("%-16s %10s %12s %12s" % ("stage", "seconds", "lines/s", "nodes/s"))
+
+    for (stage, seconds) in zip(STAGES + ["total"], best + [sum(best)]):
+        seconds = max(seconds, 1e-9)
+
+        results["stages"][stage] = {
+            "seconds": seconds,
+            "lines_per_sec": lines / seconds,
+            "nodes_per_sec": nodes / seconds
+        }
+
+        print("%-16s %10.4f %12.0f %12.0f" % (stage, seconds, lines / seconds, nodes / seconds))
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+def bench_regenerate(opts, files):
+    '''
+    Compare the default tagging, segment(), with --details, generate()
+    and segment(), on a synthetic module of --scale: time and allocated
+    memory
+    '''
+    source = pysource.Source(generate_module(0, opts))
+
+    print("module: %d lines" % len(source.lines))
+    print("%-12s %10s %14s %14s" % ("mode", "seconds", "allocated", "peak"))
+
+    for regenerate in [True, False]:
+        best = None
+
+        for _ in range(opts.repeat):
+            parser = pyparser.Parser(debuglevel=0, regenerate=regenerate)
+            parser.load(source)
+            tree = parser.syntax_tree()
+
+            start = time.perf_counter()
+            if regenerate:
+                parser.generate(tree)
+            parser.segment(tree)
+            elapsed = time.perf_counter() - start
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        parser = pyparser.Parser(debuglevel=0, regenerate=regenerate)
+        parser.load(source)
+        tree = parser.syntax_tree()
+
+        tracemalloc.start()
+        if regenerate:
+            parser.generate(tree)
+        parser.segment(tree)
+        (allocated, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print("%-12s %10.4f %14d %14d" % (
+            "regenerate" if regenerate else "tags only", best, allocated, peak))
+
+
+def bench_modern(opts, files):
+    '''
+    Compare the node type table against a visitor lookup by type name on
+    every visit, count node types without visitor and check that the
+    regenerated source has the same syntax tree
+    '''
+    print("%-24s %6s %12s %12s %8s %8s %9s" % (
+        "file", "nodes", "name us/n", "type us/n", "speedup", "generic", "roundtrip"))
+
+    for fname in files:
+        source = pysource.Source.read(fname)
+        tree = ast.parse(source.data)
+        code = source.lines
+
+        nodes = sum(1 for _ in ast.walk(tree))
+
+        # node types the parser visits without a visitor of their own
+        generic = set()
+
+        class GenericParser(pyparser.Parser):
+            def generic_visit(self, node):
+                generic.add(type(node).__name__)
+                return super().generic_visit(node)
+
+        parser = GenericParser(debuglevel=0, regenerate=True)
+        parser.parse(source)
+        generic.discard("Module")
+
+        t_name = bench_visit(NameParser, tree, code, opts.repeat)
+        t_type = bench_visit(pyparser.Parser, tree, code, opts.repeat)
+
+        parser = pyparser.Parser(debuglevel=0, regenerate=True)
+        try:
+            parser.parse(source)
+            regenerated = ast.dump(ast.parse(''.join(parser.result)))
+            roundtrip = "ok" if regenerated == ast.dump(tree) else "differs"
+        except Exception as err:
+            roundtrip = type(err).__name__
+
+        print("%-24s %6d %12.2f %12.2f %7.1fx %8d %9s" % (
+            os.path.basename(fname), nodes,
+            t_name / nodes * 1e6, t_type / nodes * 1e6, t_name / t_type,
+            len(generic), roundtrip))
+
+        if generic:
+            print("    generic_visit: %s" % ', '.join(sorted(generic)))
+
+
+def bench_deep(opts, files):
+    '''
+    Tag the stress modules of --nesting, or the given files, with the
+    explicit stack and the recursive walk: parse time, time, peak memory
+    and whether the line tags are identical. Modules that do not parse are
+    timed converted from their tokens. Then --check and convert them in a
+    process with the default and a 1 MB stack, a file too deep must fail
+    with a parse error and not crash the interpreter.
+    '''
+    if opts.files:
+        sources = [pysource.Source.read(fname) for fname in files]
+    else:
+        sources = [pysource.Source(code, name + ".py")
+                   for (name, code) in sorted(stress_modules(opts.nesting).items())]
+
+    print("%-16s %7s %12s %12s %12s %12s %12s" % (
+        "file", "lines", "parse s", "stack s", "peak", "recursive s", "same tags"))
+
+    for source in sources:
+        results = []
+
+        start = time.perf_counter()
+        try:
+            tree = pyparser.parse_tree(os.linesep.join(source.lines))
+            parsed = "%12.4f" % (time.perf_counter() - start)
+        except pyparser.PARSE_ERRORS as err:
+            parser = pyparser.Parser(debuglevel=0, fallback=True)
+
+            start = time.perf_counter()
+            parser.parse(source)
+
+            print("%-16s %7d %12s %12.4f  from tokens" % (
+                os.path.basename(source.filename), len(source.lines),
+                type(err).__name__[:12], time.perf_counter() - start))
+            continue
+
+        for cls in [pyparser.Parser, RecursiveParser]:
+            parser = cls(debuglevel=0)
+            parser.load(source)
+
+            start = time.perf_counter()
+            try:
+                parser.segment(tree)
+                elapsed = "%12.4f" % (time.perf_counter() - start)
+            except RecursionError:
+                elapsed = "%12s" % "RecursionErr"
+
+            tags = parser.tags
+
+            parser.context.allocate()
+            tracemalloc.start()
+            try:
+                parser.segment(tree)
+            except RecursionError:
+                pass
+            (_, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results.append((elapsed, peak, tags))
+
+        ((t_stack, peak, tags), (t_recursive, _, reference)) = results
+        same = "yes" if t_recursive.strip()[0].isdigit() and tags == reference else "-"
+
+        print("%-16s %7d %s %s %12d %s %12s" % (
+            os.path.basename(source.filename), len(source.lines),
+            parsed, t_stack, peak, t_recursive, same))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for source in sources:
+            paths.append(os.path.join(tmpdir, os.path.basename(source.filename)))
+            with open(paths[-1], 'wb') as f:
+                f.write(source.data)
+
+        for stack in [None, 1024 * 1024]:
+            def limit_stack():
+                if stack is not None:
+                    resource.setrlimit(resource.RLIMIT_STACK, (stack, stack))
+
+            # --output without a file writes <file>.ipynb
+            for args in [["--check", "--jobs", "1"], ["--no-cache", "--output"]]:
+                proc = subprocess.run([sys.executable, nbconvert.__file__] + paths + args,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      preexec_fn=limit_stack)
+
+                print("\n%s, %s stack: exit status %d%s" % (
+                    args[0], "default" if stack is None else "%d KB" % (stack // 1024),
+                    proc.returncode, ", interpreter crashed" if proc.returncode < 0 else ""))
+                for line in (proc.stdout + proc.stderr).decode('utf-8').splitlines():
+                    print("    " + line[:100])
+
+
+def bench_discover(opts, files):
+    '''
+    Compare the os.walk discovery with nbfind on the --dir tree: files
+    found, time to the first file and in total
+    '''
+    def walk(root):
+        for dpath, _, filenames in os.walk(root):
+            for fname in filenames:
+                if fname[-3:] == '.py':
+                    yield dpath + '/' + fname
+
+    print("%-10s %8s %12s %12s" % ("discovery", "files", "first s", "total s"))
+
+    for (name, discover) in [("os.walk", walk), ("nbfind", nbfind.find)]:
+        best = None
+
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            first = None
+            count = 0
+
+            for _ in discover(opts.dir):
+                if first is None:
+                    first = time.perf_counter() - start
+                count += 1
+
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best[2]:
+                best = (count, first or 0.0, elapsed)
+
+        print("%-10s %8d %12.6f %12.6f" % ((name,) + best))
+
+
+def bench_check(opts, files):
+    '''
+    Time --check per file: the full Parser.parse it used to run against
+    the ast only check_file()
+    '''
+    sys.argv = [sys.argv[0], "--check", "--jobs", "1"]
+    nbconvert.opts = nbconvert.parse_arguments()
+
+    def parse(fname):
+        parser = pyparser.Parser(debuglevel=0)
+        parser.parse(pysource.Source.read(fname))
+
+    print("%-12s %8s %12s %12s" % ("check", "files", "seconds", "ms/file"))
+
+    for (name, check) in [("Parser.parse", parse), ("check_file", nbconvert.check_file)]:
+        best = None
+
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            for fname in files:
+                check(fname)
+            elapsed = time.perf_counter() - start
+
+            best = elapsed if best is None else min(best, elapsed)
+
+        print("%-12s %8d %12.6f %12.3f" % (name, len(files), best, best / len(files) * 1e3))
+
+
+def bench_fallback(opts, files):
+    '''
+    Time the segmentation of the files from the ast against the token
+    segmentation used for files that do not parse, and count the files
+    where the notebooks differ
+    '''
+    def from_ast(fname):
+        parser = pyparser.Parser(debuglevel=0)
+        parser.parse(fname)
+        return parser
+
+    def from_tokens(fname):
+        parser = pyparser.Parser(debuglevel=0)
+        parser.load(fname)
+        parser.segment_tokens()
+        return parser
+
+    print("%-12s %8s %12s %12s %8s" % ("segment", "files", "seconds", "ms/file", "differ"))
+
+    expected = [list(from_ast(fname).notebook()) for fname in files]
+
+    for (name, segment) in [("ast", from_ast), ("tokens", from_tokens)]:
+        best = None
+
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            for fname in files:
+                segment(fname)
+            elapsed = time.perf_counter() - start
+
+            best = elapsed if best is None else min(best, elapsed)
+
+        differ = sum(list(segment(fname).notebook()) != cells
+                     for (fname, cells) in zip(files, expected))
+
+        print("%-12s %8d %12.6f %12.3f %8d" % (name, len(files), best,
+                                              best / len(files) * 1e3, differ))
+
+
+def write_data_module(fname, size):
+    '''
+    Write a generated module of about size MB: data tables, each with a
+    comment and an accessor function
+    '''
+    row = "    (%d, 'name_%d', %d.5, [%d, %d, %d], {'key': %d}),\n"
+
+    with open(fname, 'w') as f:
+        f.write('"""\nGenerated data tables\n"""\n\nimport os\n')
+
+        table = 0
+        while f.tell() < size * 1024 * 1024:
+            f.write("\n# table %d\nTABLE_%d = [\n" % (table, table))
+            for idx in range(1000):
+                f.write(row % (idx, idx, idx, idx, idx + 1, idx + 2, idx))
+            f.write("]\n\n\ndef table_%d(index):\n    return TABLE_%d[index]\n" % (table, table))
+            table += 1
+
+
+def bench_stream(opts, files):
+    '''
+    Peak memory and time of the conversion of a --size MB generated module
+    in memory and with --stream, the notebooks must be the same
+    '''
+    command = [sys.executable, os.path.join(os.path.dirname(__file__) or '.', "nbconvert.py"),
+               "--no-cache"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, "data.py")
+        write_data_module(fname, opts.size)
+        output = os.path.join(tmpdir, "data.ipynb")
+
+        print("%-10s %10s %10s %12s %s" % ("mode", "file MB", "seconds", "peak RSS MB", "sha256"))
+
+        for (name, limit) in [("in memory", "1000000"), ("stream", "0")]:
+            start = time.perf_counter()
+            process = subprocess.Popen(command + ["--stream", limit, fname, "--output"])
+            (_, status, usage) = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+
+            if status != 0:
+                raise RuntimeError("conversion failed")
+
+            with open(output, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:16]
+
+            # ru_maxrss is in kB on linux
+            print("%-10s %10.1f %10.2f %12.1f %s" % (
+                name, os.path.getsize(fname) / 1024 / 1024, elapsed,
+                usage.ru_maxrss / 1024, digest))
+
+
+def write_syscalls():
+    '''
+    Return the number of write system calls of the process so far
+    '''
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line[:6] == 'syscw:':
+                return int(line.split()[1])
+
+    return 0
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def legacy_convert(parser, filename):
+    '''
+    Write the notebook like convert() did before output_file(): the target
+    is opened in place, written chunk by chunk and never closed
+    '''
+    parser.parse(filename)
+    notebook = pynotebook.Notebook(debuglevel=0)
+
+    f_out = open(filename[:-3] + '.ipynb', 'w')
+
+    for content in nbconvert.notebook_chunks(parser, notebook):
+        f_out.write(content)
+
+    return f_out
+
+
+def bench_output(opts, files):
+    '''
+    Write the notebooks of --modules synthetic modules in place and through
+    output_file(): time, write system calls and peak open file descriptors
+    '''
+    sys.argv = [sys.argv[0], "--no-cache", "--output"]
+    nbconvert.opts = nbconvert.parse_arguments()
+    nbconvert.profile = nbconvert.open_profile(nbconvert.opts)
+
+    print("%-12s %8s %10s %12s %10s" % ("writer", "files", "seconds", "writes/file", "peak fds"))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        names = []
+        for index in range(opts.modules):
+            names.append(os.path.join(tmpdir, "module_%05d.py" % index))
+            with open(names[-1], 'w') as f:
+                f.write(generate_module(index, opts))
+
+        for writer in ["in place", "output_file"]:
+            parser = pyparser.Parser(debuglevel=0)
+            handles = []
+            peak = open_fds()
+
+            start = time.perf_counter()
+            writes = write_syscalls()
+
+            for fname in names:
+                if writer == "in place":
+                    # a reference keeps the handle open, like a traceback
+                    # or a reference cycle does
+                    handles.append(legacy_convert(parser, fname))
+                else:
+                    nbconvert.convert(parser, fname)
+
+                peak = max(peak, open_fds())
+
+            for handle in handles:
+                handle.close()
+
+            writes = write_syscalls() - writes
+            elapsed = time.perf_counter() - start
+
+            print("%-12s %8d %10.4f %12.2f %10d" % (
+                writer, len(names), elapsed, writes / len(names), peak))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_serve(opts, files):
+    '''
+    Request latency p50/p99 of cold command line runs, command line runs
+    through the --serve daemon and requests on an open daemon connection.
+    The run fails if the client runs are not clearly faster than the cold
+    runs.
+    '''
+    command = [sys.executable, "-W", "ignore", os.path.join(os.path.dirname(__file__) or '.',
+                                                            "nbconvert.py")]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "nbconvert.sock")
+
+        server = subprocess.Popen(command + ["--serve", "--socket", path],
+                                  stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(path):
+                if server.poll() is not None:
+                    raise RuntimeError("daemon did not start")
+                time.sleep(0.01)
+
+            def cold(fname):
+                subprocess.run(command + ["--no-cache", fname],
+                               stdout=subprocess.DEVNULL, check=True)
+
+            def client(fname):
+                subprocess.run(command + ["--client", "--socket", path, fname],
+                               stdout=subprocess.DEVNULL, check=True)
+
+            with nbclient.Client(path) as connection:
+                def request(fname):
+                    response = connection.request({"path": os.path.abspath(fname)})
+                    if "error" in response:
+                        raise RuntimeError(response["error"])
+
+                modes = [("cold cli", cold), ("client cli", client), ("connection", request)]
+                latencies = {name: [] for (name, _) in modes}
+
+                # the modes take turns, a drift of the machine hits them alike
+                for _ in range(opts.repeat):
+                    for fname in files:
+                        for (name, run) in modes:
+                            start = time.perf_counter()
+                            run(fname)
+                            latencies[name].append(time.perf_counter() - start)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print("%-12s %8s %10s %10s" % ("mode", "requests", "p50 ms", "p99 ms"))
+
+    for (name, _) in modes:
+        print("%-12s %8d %10.2f %10.2f" % (
+            name, len(latencies[name]),
+            percentile(latencies[name], 0.5) * 1e3, percentile(latencies[name], 0.99) * 1e3))
+
+    cold_p50 = percentile(latencies["cold cli"], 0.5)
+    client_p50 = percentile(latencies["client cli"], 0.5)
+
+    if client_p50 > CLIENT_SHARE * cold_p50:
+        print("client cli not clearly faster than cold cli: p50 %.2f ms against %.2f ms" % (
+            client_p50 * 1e3, cold_p50 * 1e3))
+        sys.exit(1)
+
+
+def import_time(stderr):
+    '''
+    Return the number of modules and the total import time in seconds of
+    the -X importtime report in stderr
+    '''
+    modules = 0
+    total = 0
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        modules += 1
+        total += int(line.split(":", 1)[1].split("|")[0])
+
+    return (modules, total * 1e-6)
+
+
+def bench_startup(opts, files):
+    '''
+    Wall time and -X importtime import time of the short command line
+    paths: --version, --help and a --client run through a daemon, against
+    the bare interpreter. The run fails if a path spends more than --budget
+    ms importing.
+    '''
+    command = [sys.executable, "-X", "importtime", "-W", "ignore",
+               os.path.join(os.path.dirname(__file__) or '.', "nbconvert.py")]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "nbconvert.sock")
+
+        server = subprocess.Popen(command + ["--serve", "--socket", path],
+                                  stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(path):
+                if server.poll() is not None:
+                    raise RuntimeError("daemon did not start")
+                time.sleep(0.01)
+
+            paths = [("python", [sys.executable, "-X", "importtime", "-c", "pass"]),
+                     ("--version", command + ["--version"]),
+                     ("--help", command + ["--help"]),
+                     ("--client", command + ["--client", "--socket", path] + files[:1])]
+
+            print("%-12s %8s %10s %10s %10s" % ("path", "modules", "wall ms", "p99 ms", "import ms"))
+
+            over = []
+
+            for (name, argv) in paths:
+                latencies = []
+                imports = []
+
+                for _ in range(opts.repeat):
+                    start = time.perf_counter()
+                    result = subprocess.run(argv, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.PIPE, text=True, check=True)
+                    latencies.append(time.perf_counter() - start)
+
+                    (modules, seconds) = import_time(result.stderr)
+                    imports.append(seconds)
+
+                importms = percentile(imports, 0.5) * 1e3
+
+                print("%-12s %8d %10.2f %10.2f %10.2f" % (
+                    name, modules, percentile(latencies, 0.5) * 1e3,
+                    percentile(latencies, 0.99) * 1e3, importms))
+
+                if name != "python" and importms > opts.budget:
+                    over.append(name)
+        finally:
+            server.terminate()
+            server.wait()
+
+    if over:
+        print("import time over the budget of %.2f ms: %s" % (opts.budget, ", ".join(over)))
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    "dispatch": bench_dispatch,
+    "debug": bench_debug,
+    "notebook": bench_notebook,
+    "memory": bench_memory,
+    "pipeline": bench_pipeline,
+    "regenerate": bench_regenerate,
+    "modern": bench_modern,
+    "deep": bench_deep,
+    "discover": bench_discover,
+    "check": bench_check,
+    "fallback": bench_fallback,
+    "stream": bench_stream,
+    "output": bench_output,
+    "serve": bench_serve,
+    "startup": bench_startup,
+}
+
+
+def main():
+    '''
+    Run the selected benchmark
+    '''
+    opts = parse_arguments()
+
+    if opts.generate:
+        generate(opts)
+        return
+
+    if opts.stress:
+        generate_stress(opts)
+        return
+
+    BENCHMARKS[opts.bench](opts, find_files(opts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+    Cache
+    ~~~~~
+
+    On-disk cache of converted notebooks.
+
+    Entries are keyed by the hash of the source file content and a
+    fingerprint of the converter, so a file is only converted again if it or
+    the converter changed. The cache is bounded in size, the least recently
+    used entries are evicted first.
+
+    :license: BSD.
+"""
+
+import os
+import hashlib
+import tempfile
+
+
+class Cache():
+
+    suffix = '.ipynb'
+
+    def __init__(self, path, maxsize, fingerprint=""):
+        # the fingerprint string, or a function returning it on first use
+        self.path = path
+        self.maxsize = maxsize
+        self.fingerprint = fingerprint
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source):
+        '''
+        Return the cache key for the source file content (bytes)
+        '''
+        if callable(self.fingerprint):
+            self.fingerprint = self.fingerprint()
+
+        digest = hashlib.sha256(self.fingerprint.encode('utf-8'))
+        digest.update(source)
+
+        return digest.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key + self.suffix)
+
+    def get(self, key):
+        '''
+        Return the cached notebook or None, and count the hit or miss
+        '''
+        path = self.entry(key)
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                notebook = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        # mark as recently used for evict()
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return notebook
+
+    def put(self, key, notebook):
+        '''
+        Store a notebook, concurrent writers never see a partial entry
+        '''
+        path = self.entry(key)
+        dirname = os.path.dirname(path)
+
+        os.makedirs(dirname, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(notebook)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits maxsize,
+        return the number of removed entries
+        '''
+        entries = []
+        total = 0
+
+        for dpath, _, filenames in os.walk(self.path):
+            for fname in filenames:
+                if fname[-len(self.suffix):] != self.suffix:
+                    continue
+
+                path = os.path.join(dpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        removed = 0
+        for (_, size, path) in sorted(entries):
+            if total <= self.maxsize:
+                break
+
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+            total -= size
+            removed += 1
+
+        return removed
@@ -0,0 +1,120 @@
+"""
+    Client
+    ~~~~~~
+
+    Client of the --serve daemon and the frames both ends exchange, see
+    nbserve for the protocol. It is kept apart from the daemon, a --client
+    run does not import socketserver. The client uses the bare _socket
+    module, the socket module builds its enums and imports selectors on
+    every start, which costs as much as the converter a client run saves.
+
+    :license: BSD.
+"""
+
+import os
+import json
+import struct
+import _socket
+
+HEADER = struct.Struct('>I')
+
+# largest frame accepted
+MAXSIZE = 256 * 1024 * 1024
+
+
+def default_socket():
+    '''
+    Return the default socket path of the daemon
+    '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'nbconvert.sock')
+
+    # not tempfile.gettempdir(), importing tempfile costs more than a
+    # --client run saves
+    tmpdir = os.environ.get('TMPDIR') or '/tmp'
+
+    return os.path.join(tmpdir, 'nbconvert-%d.sock' % os.getuid())
+
+
+def receive_exactly(sock, size):
+    '''
+    Return size bytes from sock, None if the peer closed before the first
+    '''
+    chunks = []
+
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            if chunks:
+                raise ConnectionError("connection closed within a frame")
+            return None
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def send(sock, message):
+    '''
+    Send a message as one frame
+    '''
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receive(sock):
+    '''
+    Return the next message, None if the peer closed the connection
+    '''
+    header = receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+
+    (size,) = HEADER.unpack(header)
+    if size > MAXSIZE:
+        raise ConnectionError("frame of %d bytes exceeds %d" % (size, MAXSIZE))
+
+    data = receive_exactly(sock, size) if size else b''
+    if data is None:
+        raise ConnectionError("connection closed within a frame")
+
+    return json.loads(data.decode('utf-8'))
+
+
+class Client():
+    '''
+    Connection to the daemon, raises OSError if none is running
+    '''
+
+    def __init__(self, path, timeout=None):
+        self.sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def request(self, message):
+        '''
+        Send a request, return the response
+        '''
+        send(self.sock, message)
+
+        response = receive(self.sock)
+        if response is None:
+            raise ConnectionError("daemon closed the connection")
+
+        return response
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,34 +1,86 @@
 #!/usr/local/bin/python3
 
-from argparse import ArgumentParser as ArgParser
-
+import io
 import os
 import sys
-import inspect
+import contextlib
+import importlib.util
 
-import pyparser
-import pynotebook 
+from stat import S_ISREG
 
+import pydebug
 
-debuglevel = 0
-opts = None
 
-def debug(level, line):
+def lazy_import(name):
     '''
-    Write debug message to output
+    Return a module that is only loaded on first attribute access, short
+    runs like --version or --client do not pay for the converter
     '''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
 
-    call = inspect.stack()[1][3]
 
-    if level <= debuglevel:
-        print("DBG: %-10s %1d/%1d %s" % (call, level, debuglevel, line))
+json = lazy_import("json")
+signal = lazy_import("signal")
+hashlib = lazy_import("hashlib")
+tempfile = lazy_import("tempfile")
+concurrent = lazy_import("concurrent.futures")
+
+nbcache = lazy_import("nbcache")
+nbclient = lazy_import("nbclient")
+nbfind = lazy_import("nbfind")
+nbprofile = lazy_import("nbprofile")
+nbserve = lazy_import("nbserve")
+nbwatch = lazy_import("nbwatch")
+pyparser = lazy_import("pyparser")
+pysource = lazy_import("pysource")
+pynotebook = lazy_import("pynotebook")
+
+
+__version__ = "1.0.0"
+
+debuglevel = 0
+opts = None
+cache = None
+
+# --profile recorder, see open_profile()
+profile = None
+
+# convert() result of a file skipped by --update
+UPTODATE = 2
+
+# convert() result of a file converted from its tokens, it does not parse
+FALLBACK = 3
+
+# converter stamp, see converter_id()
+converter = None
+
+# write buffer of the notebook files, a notebook is written in few writes
+BUFSIZE = 256 * 1024
+
+# end of a notebook file read for its stamp, see read_stamp()
+TAILSIZE = 64 * 1024
+
+# Write debug message to output
+debug = pydebug.Debug(fmt="DBG: %(call)-10s %(level)1d/%(debuglevel)1d %(line)s")
 
 
 def version():
     '''
     print current version string
     '''
-    print("%s: Version 1.0.0" % __file__)
+    print("%s: Version %s" % (__file__, __version__))
     sys.exit(0)
 
 
@@ -36,6 +88,8 @@ def parse_arguments():
     '''
     Parse command line arguments
     '''
+    from argparse import ArgumentParser as ArgParser
+
     parser = ArgParser()
 
     parser.add_argument("files", nargs="*")
@@ -44,15 +98,74 @@ def parse_arguments():
     parser.add_argument('--output', action='store', nargs="?", default="")
     parser.add_argument('--debug',  action='store', type=int, default=0)
     parser.add_argument('--dir',    action='store', type=str, default=".")
+    parser.add_argument('--include', action='append', default=[],
+                        help="glob of the files to convert, default *.py")
+    parser.add_argument('--exclude', action='append', default=[],
+                        help="glob of the files and directories to skip")
     parser.add_argument('--version', action='store_true')
     parser.add_argument('--details', action='store_true')
     parser.add_argument('--verbose', dest="verbose",
                         action='store_true', default=True)
     parser.add_argument('--quiet', dest="verbose", action='store_false')
-    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--strict', action='store_true',
+                        help="fail on files that do not parse instead of "
+                             "converting them from their tokens")
+    parser.add_argument('--check', action='store_true',
+                        help="only check that the files parse, exit 1 if one does not")
+    parser.add_argument('--jobs',   action='store', type=int, default=None,
+                        help="worker processes, default 1 or the CPU count with "
+                             "--watch and --check")
+    parser.add_argument('--no-cache', dest="cache", action='store_false', default=True)
+    parser.add_argument('--cache-dir', action='store', type=str,
+                        default=os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                             os.path.expanduser('~/.cache')), 'nbconvert'))
+    parser.add_argument('--cache-size', action='store', type=int, default=64,
+                        help="cache size limit in MB")
+    parser.add_argument('--profile', action='store_true',
+                        help="report stage timings and visitor counts to stderr")
+    parser.add_argument('--profile-format', action='store', default="table",
+                        choices=["table", "json"])
+    parser.add_argument('--update', action='store_true',
+                        help="skip files whose notebook is up to date")
+    parser.add_argument('--stream', action='store', type=float, default=64,
+                        help="convert files larger than this many MB a top-level "
+                             "statement at a time, 0 for every file")
+    parser.add_argument('--merge', action='store_true',
+                        help="keep outputs and execution counts of the existing notebook")
+    parser.add_argument('--serve', action='store_true',
+                        help="run the conversion daemon on --socket")
+    parser.add_argument('--client', action='store_true',
+                        help="convert through the daemon, in process if none is running")
+    parser.add_argument('--socket', action='store', type=str, default=None,
+                        help="daemon socket, default $XDG_RUNTIME_DIR/nbconvert.sock")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep converting changed files to <file>.ipynb")
+    parser.add_argument('--interval', action='store', type=float, default=1.0,
+                        help="--watch poll interval in seconds")
+    parser.add_argument('--debounce', action='store', type=float, default=0.5,
+                        help="--watch quiet time before a batch is converted")
 
     opts = parser.parse_args()
 
+    if opts.include == []:
+        opts.include = ["*.py"]
+
+    if opts.jobs is None:
+        opts.jobs = (os.cpu_count() or 1) if opts.watch or opts.check else 1
+
+    if opts.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if opts.jobs > 1 and opts.output and not opts.check:
+        parser.error("--output FILE can not be combined with --jobs")
+
+    if opts.watch:
+        if opts.output or opts.check or opts.details:
+            parser.error("--watch writes <file>.ipynb, it can not be combined with "
+                         "--output FILE, --check or --details")
+
+        opts.output = None
+
     # Print the version and exit
     if opts.version:
         version()
@@ -60,41 +173,436 @@ def parse_arguments():
     if opts.check:
         opts.verbose = False
 
+    if opts.socket is None and (opts.serve or opts.client):
+        opts.socket = nbclient.default_socket()
+
     # if opts.file:
     #    opts.files.append(opts.file)
 
     global debuglevel
     debuglevel = opts.debug
+    debug.debuglevel = debuglevel
 
     return opts
 
 
+def fingerprint():
+    '''
+    Identify the converter: version, notebook layout and metadata, celltype
+    rules and the parser and notebook code
+    '''
+    notebook = pynotebook.Notebook(debuglevel=0)
+
+    parts = [
+        __version__,
+        repr(notebook.indent),
+        notebook.nb_start(),
+        notebook.nb_end(),
+        repr(sorted(pyparser.PYTHON_ELEMENTS.items()))
+    ]
+
+    for module in (pyparser, pynotebook):
+        with open(module.__file__, 'rb') as f:
+            parts.append(hashlib.sha256(f.read()).hexdigest())
+
+    return '\n'.join(parts)
+
+
+def converter_id():
+    '''
+    Return a short identifier of the converter, see fingerprint()
+    '''
+    global converter
+
+    if converter is None:
+        converter = hashlib.sha256(fingerprint().encode('utf-8')).hexdigest()[:16]
+
+    return converter
+
+
+def stamp(digest, stat=None):
+    '''
+    Return the notebook metadata stamp for the sha256 hash object of the
+    source file content, with the mtime and size of its os.stat_result
+    '''
+    notebook_stamp = {
+        "version": __version__,
+        "converter": converter_id(),
+        "source": digest.hexdigest()
+    }
+
+    if stat is not None:
+        notebook_stamp["mtime"] = stat.st_mtime_ns
+        notebook_stamp["size"] = stat.st_size
+
+    return notebook_stamp
+
+
+def read_stamp(output):
+    '''
+    Return the stamp of a notebook file, None if it has none. Only the end
+    of the file is read, nb_end() writes the metadata last.
+    '''
+    with open(output, 'rb') as f:
+        f.seek(max(0, os.fstat(f.fileno()).st_size - TAILSIZE))
+        tail = f.read().decode('utf-8', errors='replace')
+
+    # within a JSON string the quotes would be escaped
+    start = tail.rfind('"nbconvert": ')
+    if start < 0:
+        return None
+
+    return json.JSONDecoder().raw_decode(tail, start + len('"nbconvert": '))[0]
+
+
+def restamp(text, notebook):
+    '''
+    Return notebook text with the metadata of notebook, a cached notebook
+    carries the stamp of the file it was converted from
+    '''
+    end = text.rfind('\n' + notebook.indent + '],\n' + notebook.indent + '"metadata": ')
+    if end < 0:
+        return text
+
+    return text[:end] + notebook.nb_end()
+
+
+def uptodate(filename):
+    '''
+    Return True if the notebook of filename was written by this converter
+    from the same source: stamped with the same mtime and size, or else
+    with the same content hash. Mtimes can move both ways on a checkout or
+    copy, only an exact match counts.
+    '''
+    output = output_name(filename)
+
+    if output == "":
+        return False
+
+    try:
+        stat = os.stat(filename)
+        notebook_stamp = read_stamp(output)
+
+        if notebook_stamp is None or notebook_stamp["converter"] != converter_id():
+            return False
+
+        if notebook_stamp.get("mtime") == stat.st_mtime_ns and \
+                notebook_stamp.get("size") == stat.st_size:
+            return True
+
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for data in iter(lambda: f.read(BUFSIZE), b''):
+                digest.update(data)
+
+        return notebook_stamp["source"] == digest.hexdigest()
+
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+class Disabled():
+    '''
+    Profile that records nothing, without --profile nbprofile is not loaded
+    '''
+
+    enabled = False
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def done(self, filename):
+        pass
+
+
+DISABLED = Disabled()
+
+
+def open_profile(opts):
+    '''
+    Return the --profile recorder, DISABLED if off
+    '''
+    if not opts.profile:
+        return DISABLED
+
+    return nbprofile.Profile()
+
+
+def new_parser():
+    '''
+    Return a parser for the command line options
+    '''
+    if profile.enabled:
+        return nbprofile.ProfileParser(profile, debuglevel=debuglevel,
+                                       regenerate=opts.details, fallback=not opts.strict)
+
+    return pyparser.Parser(debuglevel=debuglevel, regenerate=opts.details,
+                           fallback=not opts.strict)
+
+
+def open_cache(opts):
+    '''
+    Return the conversion cache, None if disabled. The converter is only
+    fingerprinted when the cache is first used.
+    '''
+    if not opts.cache:
+        return None
+
+    return nbcache.Cache(opts.cache_dir, opts.cache_size * 1024 * 1024, fingerprint)
+
+
+def output_name(filename):
+    '''
+    Return the notebook file name for filename, "" for stdout
+    '''
+    if opts.output == None:
+        return filename[:-3] + '.ipynb'
+
+    return opts.output
+
+
+def load_notebook(filename):
+    '''
+    Return the existing notebook written for filename for --merge, None if
+    there is none
+    '''
+    output = output_name(filename)
+
+    if not opts.merge or output == "":
+        return None
+
+    try:
+        with open(output, encoding='utf-8') as f:
+            return json.load(f)
+    except OSError:
+        return None
+    except ValueError as err:
+        print("WARNING: outputs of %s not kept: %s" % (output, err), file=sys.stderr)
+        return None
+
+
+def write_cached(filename, text):
+    '''
+    Write a cached notebook, keep an existing notebook with the same content
+    '''
+    output = output_name(filename)
+
+    if output == "":
+        sys.stdout.write(text)
+        return
+
+    try:
+        with open(output, encoding='utf-8') as f:
+            if f.read() == text:
+                debug(1, "keep %s", output)
+                return
+    except OSError:
+        pass
+
+    with output_file(output) as f_out:
+        f_out.write(text)
+
+
+@contextlib.contextmanager
+def output_file(output):
+    '''
+    Open a notebook file for writing, "" is stdout.
+
+    The notebook is buffered in a temp file in the target directory that
+    replaces the target when the block succeeds, readers never see a half
+    written notebook. On error the temp file is removed and the target
+    kept. A target that is not a regular file, like /dev/null or a pipe,
+    is written directly. The file is closed when the block ends.
+    '''
+    if output == "":
+        yield sys.stdout
+        return
+
+    (dirname, basename) = os.path.split(output)
+
+    try:
+        st = os.stat(output)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    else:
+        if not S_ISREG(st.st_mode):
+            with open(output, 'w', encoding='utf-8', buffering=BUFSIZE) as f:
+                yield f
+            return
+
+        mode = st.st_mode & 0o7777
+
+    fd, tmp = tempfile.mkstemp(dir=dirname or '.', prefix='.' + basename, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', buffering=BUFSIZE) as f:
+            yield f
+        os.chmod(tmp, mode)
+        os.replace(tmp, output)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def notebook_lines(parser, rows=None):
+    '''
+    Yield the (change, celltype, line) triples of the parsed code or of
+    the rows of Parser.stream(), a line None ends the notebook
+    '''
+    celltype = "C"
+
+    for line in parser.notebook(rows):
+        if line is None:
+            debug(2, "last line:")
+
+            yield ("1", celltype, line)
+        else:
+            (_lineno, _line, change, celltype) = line
+
+            if change:
+                prefix=celltype
+            else:
+                prefix="-"
+
+            debug(4, "%4s: change: %s prefix: %s %-60s", _lineno, change, prefix, _line)
+
+            yield (change, celltype, _line)
+
+
+def notebook_chunks(parser, notebook, rows=None):
+    '''
+    Yield the notebook JSON text of the parsed code, cell by cell, see
+    notebook_lines() for rows
+    '''
+    for (change, celltype, line) in notebook_lines(parser, rows):
+        content = notebook.cell(change, celltype, line)
+
+        if content:
+            yield content
+
+
+def parse_source(source, filename="<string>"):
+    '''
+    Parse source code given as str, bytes or file object, return the parser
+    '''
+    if hasattr(source, 'read'):
+        filename = getattr(source, 'name', filename)
+        source = source.read()
+
+    parser = pyparser.Parser(debuglevel=debuglevel)
+    parser.parse(pysource.Source(source, filename))
+
+    return parser
+
+
+def notebook_text(parser, source, filename="<string>", stat=None):
+    '''
+    Return the notebook JSON text of source (str or bytes) as convert()
+    writes it, stat is the os.stat_result of the file read
+    '''
+    source = pysource.Source(source, filename)
+    parser.parse(source)
+
+    notebook = pynotebook.Notebook(debuglevel=debuglevel)
+    notebook.stamp = stamp(hashlib.sha256(source.data), stat)
+
+    return ''.join(notebook_chunks(parser, notebook))
+
+
+def convert_iter(source, filename="<string>", keep=None):
+    '''
+    Convert python source code given as str, bytes or file object.
+
+    Yields the notebook JSON text in chunks of one or more cells, only the
+    current cell is kept in memory. Parse errors raise SyntaxError.
+    Code cells with the same source as in the notebook dict <keep> keep
+    its outputs and execution counts.
+    '''
+    parser = parse_source(source, filename)
+    notebook = pynotebook.Notebook(debuglevel=debuglevel)
+
+    if keep is not None:
+        notebook.keep(keep)
+
+    return notebook_chunks(parser, notebook)
+
+
+def convert_to_dict(source, filename="<string>", keep=None):
+    '''
+    Convert python source code given as str, bytes or file object to an
+    nbformat 4 notebook dict, see convert_iter() for keep
+    '''
+    parser = parse_source(source, filename)
+    notebook = pynotebook.Notebook(debuglevel=debuglevel)
+
+    if keep is not None:
+        notebook.keep(keep)
+
+    cells = list(notebook.celldicts(notebook_lines(parser)))
+
+    return notebook.document(cells)
+
+
 def convert(parser, filename):
+    '''
+    Convert one file, return 0 on success, UPTODATE if --update skipped
+    it and FALLBACK if it does not parse and was converted from its tokens
+    '''
     global opts
 
-    code = ""
+    if opts.update and uptodate(filename):
+        debug(1, "up to date: %s", filename)
+        return UPTODATE
+
+    # --details needs the whole code
+    if not opts.details and streaming(filename):
+        try:
+            return convert_stream(parser, filename)
+        except pyparser.PARSE_ERRORS as err:
+            # the temp file was dropped, start over
+            debug(1, "stream %s: %s, convert in memory", filename, err)
+
+    cache_key = None
+    notebook = pynotebook.Notebook(debuglevel=debuglevel)
+
+    debug(4, "read file: %s", filename)
+    with profile.stage("read"):
+        source = pysource.Source.read(filename)
+    code = source.lines
+
+    # --merge: outputs of the existing notebook are kept, cells without
+    # outputs come out the same and the cache still applies
+    previous = load_notebook(filename)
+    merged = previous is not None and notebook.keep(previous) > 0
+
+    notebook.stamp = stamp(hashlib.sha256(source.data), source.stat)
+
+    # --details needs the parser
+    if cache is not None and not opts.details and not merged:
+        cache_key = cache.key(source.data)
+
+        text = cache.get(cache_key)
+        if text is not None:
+            debug(1, "cache hit: %s", filename)
+            write_cached(filename, restamp(text, notebook))
+            return 0
+
+    debug(4, "parse: %s", filename)
+    parser.parse(source)
+
     result = 0
-    try:
-        debug(4, "read file: %s" % filename)
-        with open(filename) as f:
-            code = [line.rstrip() for line in f.readlines()]
-
-        debug(4, "parse: %s" % filename)
-        parser.parse(filename)
-    except Exception as err:
-        if opts.check:
-            result = 1
-            print("Unexpected error:", err)
-        else:
-            raise err
 
-    if opts.check:
-        if result == 0:
-            print("PARSE: %s" % filename)
-        else:
-            print("ERROR: parsing %s" % filename)
+    if parser.error is not None:
+        print("WARNING: %s, converted from its tokens" %
+              fallback_error(parser, filename), file=sys.stderr)
 
-        sys.exit()
+        # not cached, every run reports it
+        cache_key = None
+        result = FALLBACK
 
     if opts.details:
         print("Code:" + '-' * 75)
@@ -105,66 +613,464 @@ def convert(parser, filename):
         print(''.join(parser.result))
 
         print("Lines:" + '-' * 74)
-        for key in parser.lines:
-            print(key, parser.lines[key])
+        for lineno, tags in enumerate(parser.tags):
+            if tags & pyparser.TAG_LINE:
+                print(lineno, parser.context.describe(lineno))
+
+    output = output_name(filename)
+
+    debug(1, "convert %s to %s", filename, output)
+
+    chunks = []
+
+    with profile.stage("write"), output_file(output) as f_out:
+        for content in profile.timed("Notebook.cell", notebook_chunks(parser, notebook)):
+            f_out.write(content)
+
+            if cache_key is not None:
+                chunks.append(content)
+
+    if cache_key is not None:
+        cache.put(cache_key, ''.join(chunks))
 
+    return result
+
+
+def streaming(filename):
+    '''
+    Return whether filename is converted with convert_stream(), see
+    --stream. Notebooks written to stdout are not streamed, a parse error
+    could not take back what was written.
+    '''
+    if output_name(filename) == "":
+        return False
+
+    try:
+        return os.stat(filename).st_size > opts.stream * 1024 * 1024
+    except OSError:
+        return False
+
+
+def convert_stream(parser, filename):
+    '''
+    Convert one file a chunk of top-level statements at a time, the file
+    is read line by line and the notebook written line by line, only the
+    current chunk is in memory. The notebook is the one convert() writes,
+    it is not cached. Parse errors raise.
+    '''
     notebook = pynotebook.Notebook(debuglevel=debuglevel)
+    notebook.linewise = True
 
-    isLastLine = False
+    previous = load_notebook(filename)
+    if previous is not None:
+        notebook.keep(previous)
 
-    output = opts.output
-    if opts.output == None:
-        output = filename[:-3] + '.ipynb'
-        f_out=open(output, 'w')
-    elif opts.output != "":
-        f_out=open(output, 'w')
+    source = pysource.Stream(filename)
+
+    def rows():
+        yield from parser.stream(source.lines())
+
+        # the metadata comes last, after the whole file was read
+        notebook.stamp = stamp(source.digest, source.stat)
+
+    output = output_name(filename)
+
+    debug(1, "stream %s to %s", filename, output)
+
+    with profile.stage("write"), output_file(output) as f_out:
+        for content in profile.timed("Notebook.cell", notebook_chunks(parser, notebook, rows())):
+            f_out.write(content)
+
+    return 0
+
+
+def parse_error(filename, err):
+    '''
+    Return the description of a parse error with its position in filename
+    '''
+    if isinstance(err, SyntaxError) and err.lineno is not None:
+        return "parsing %s:%d:%d: %s: %s" % (
+            filename, err.lineno, err.offset or 0, type(err).__name__, err.msg)
+
+    if isinstance(err, SyntaxError):
+        return "parsing %s: %s: %s" % (filename, type(err).__name__, err.msg)
+
+    return "parsing %s: %s: %s" % (filename, type(err).__name__, err)
+
+
+def fallback_error(parser, filename):
+    '''
+    Return the description of the parse error of the code that parser
+    converted from its tokens
+    '''
+    return parse_error(filename, parser.error)
+
+
+def check_file(filename):
+    '''
+    Check that a file parses without converting it, return 0 and the
+    PARSE line or 1 and the ERROR line with the position of the error
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            pyparser.parse_tree(f.read(), filename)
+    except (OSError, MemoryError) + pyparser.PARSE_ERRORS as err:
+        return (1, "ERROR: %s" % parse_error(filename, err))
+
+    return (0, "PARSE: %s" % filename)
+
+
+def check_all(files):
+    '''
+    --check the files across a pool of --jobs worker processes, print a
+    line per file in order and return the number of files that failed
+    '''
+    if opts.jobs > 1:
+        pool = concurrent.ProcessPoolExecutor(max_workers=opts.jobs)
+        checked = pool.map(check_file, files, chunksize=16)
     else:
-        f_out=sys.stdout
-        
-    debug(1, "convert %s to %s" % (filename, output))
+        pool = None
+        checked = map(check_file, files)
 
-    for line in parser.notebook():
-        if line is None:
-            debug(2, "last line:")
-        
-            f_out.write(notebook.cell("1", celltype, line))
-        else:
-            (_lineno, _line, change, celltype) = line
+    results = []
+    try:
+        for (result, line) in checked:
+            print(line)
+            results.append(result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
-            if change:
-                prefix=celltype
-            else:
-                prefix="-"
+    return report_batch(results)
+
+
+def init_job(options):
+    '''
+    Set up the command line options in a worker process
+    '''
+    global opts, debuglevel, cache, profile
+
+    opts = options
+    debuglevel = opts.debug
+    debug.debuglevel = debuglevel
+    cache = open_cache(opts)
+    profile = open_profile(opts)
+
+
+def convert_job(filename):
+    '''
+    Convert one file in a worker process with a fresh parser.
+
+    Everything the conversion prints, including a notebook written to
+    stdout, is captured and returned so the caller can print it in order.
+    '''
+    out = io.StringIO()
+    result = 0
+    error = None
+
+    if cache is not None:
+        (hits, misses) = (cache.hits, cache.misses)
+
+    with contextlib.redirect_stdout(out):
+        try:
+            result = convert(new_parser(), filename)
+        except Exception as err:
+            result = 1
+            error = "%s: %s" % (type(err).__name__, err)
+
+    profile.done(filename)
+
+    if cache is not None:
+        (hits, misses) = (cache.hits - hits, cache.misses - misses)
+    else:
+        (hits, misses) = (0, 0)
+
+    stats = profile.collect() if profile.enabled else None
+
+    return (filename, result, error, out.getvalue(), hits, misses, stats)
 
-            debug(4, "%4s: change: %s prefix: %s %-60s" % (_lineno, change, prefix, _line))
 
-            f_out.write(notebook.cell(change, celltype, _line))
+def convert_all(files):
+    '''
+    Convert files across a pool of --jobs worker processes.
+
+    Files are handed to the workers as they are found, the results are
+    reported in that order, sorted path order, whichever file finishes
+    first. Returns the number of files that failed.
+    '''
+    with concurrent.ProcessPoolExecutor(
+            max_workers=opts.jobs, initializer=init_job, initargs=(opts,)) as pool:
+
+        results = [report_job(job) for job in pool.map(convert_job, files)]
+
+    return report_batch(results)
+
+
+def report_job(job):
+    '''
+    Print the output of a convert_job(), return its result
+    '''
+    (filename, result, error, output, hits, misses, stats) = job
+
+    sys.stdout.write(output)
+
+    if cache is not None:
+        cache.hits += hits
+        cache.misses += misses
+
+    if stats is not None:
+        profile.merge(stats)
+
+    if error is not None:
+        print("ERROR: converting %s: %s" % (filename, error))
+
+    return result
+
+
+def report_batch(results):
+    '''
+    Print the summary of a batch of convert() results, return the number
+    of files that failed
+    '''
+    errors = results.count(1)
+    skipped = results.count(UPTODATE)
+    fallback = results.count(FALLBACK)
+
+    sys.stdout.flush()
+    print("%d files, %d ok, %d from tokens, %d errors, %d skipped" % (
+        len(results), len(results) - errors - skipped - fallback, fallback, errors, skipped),
+        file=sys.stderr)
+
+    return errors
+
+
+def watch():
+    '''
+    Convert the files, then keep converting the files whose content
+    changed until interrupted.
+
+    A batch is spread over the worker pool and reported as the files
+    finish, so a large file does not hold back the others.
+    '''
+    watcher = nbwatch.Watch(find_files, opts.interval, opts.debounce)
+
+    with concurrent.ProcessPoolExecutor(
+            max_workers=opts.jobs, initializer=init_job, initargs=(opts,)) as pool:
+
+        for batch in watcher.batches():
+            debug(1, "changed: %r", batch)
+
+            jobs = [pool.submit(convert_job, filename) for filename in batch]
+
+            report_batch([report_job(job.result())
+                          for job in concurrent.as_completed(jobs)])
+            report_profile()
+            report_cache()
+
+
+def report_profile():
+    '''
+    Print the --profile report of the batch and start over
+    '''
+    if not profile.enabled:
+        return
+
+    sys.stdout.flush()
+    profile.report(sys.stderr, opts.profile_format)
+    profile.collect()
+
+
+def report_cache():
+    '''
+    Print the cache statistics of the batch and trim the cache
+    '''
+    if cache is None:
+        return
+
+    removed = cache.evict()
+
+    print("cache: %d hits, %d misses, %d evicted" % (cache.hits, cache.misses, removed),
+          file=sys.stderr)
+
+
+def serve():
+    '''
+    Run the conversion daemon until interrupted
+    '''
+    def convert_source(source, filename, state, stat, strict):
+        if "parser" not in state:
+            state["parser"] = pyparser.Parser(debuglevel=debuglevel)
+
+        parser = state["parser"]
+        parser.fallback = not (opts.strict or strict)
+
+        text = notebook_text(parser, source, filename, stat)
+
+        if parser.error is None:
+            return (text, None)
+
+        return (text, fallback_error(parser, filename))
+
+    try:
+        server = nbserve.Server(opts.socket, convert_source)
+    except OSError as err:
+        print("ERROR: %s" % err, file=sys.stderr)
+        sys.exit(1)
+
+    print("serving on %s" % opts.socket, file=sys.stderr)
+
+    # remove the socket on kill as on ^C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def convert_remote(files):
+    '''
+    Convert files through the daemon, return the convert() results or
+    None if no daemon is running. Files left when the daemon goes away
+    are converted in process. A file that fails is reported and the batch
+    goes on.
+    '''
+    global cache
+
+    try:
+        client = nbclient.Client(opts.socket)
+    except OSError:
+        debug(1, "no daemon on %s", opts.socket)
+        return None
+
+    parser = None
+    results = []
+
+    with client:
+        for filename in files:
+            try:
+                if opts.update and uptodate(filename):
+                    results.append(UPTODATE)
+                    continue
+
+                response = None
+
+                if parser is None:
+                    try:
+                        response = client.request({"path": os.path.abspath(filename),
+                                                   "filename": filename,
+                                                   "strict": opts.strict})
+                    except OSError:
+                        debug(1, "daemon gone, continue in process")
+                        cache = open_cache(opts)
+                        parser = new_parser()
+
+                if response is None:
+                    results.append(convert(parser, filename))
+                elif "error" in response:
+                    print("ERROR: converting %s: %s" % (filename, response["error"]))
+                    results.append(1)
+                elif "fallback" in response:
+                    print("WARNING: %s, converted from its tokens" % response["fallback"],
+                          file=sys.stderr)
+                    write_cached(filename, response["notebook"])
+                    results.append(FALLBACK)
+                else:
+                    write_cached(filename, response["notebook"])
+                    results.append(0)
+
+            except Exception as err:
+                print("ERROR: converting %s: %s: %s" % (filename, type(err).__name__, err))
+                results.append(1)
+
+    return results
+
+
+def find_files():
+    '''
+    Yield the files given on the command line, directories given on the
+    command line or --dir are walked for the files to convert. The files
+    come in sorted path order, the order the results are reported in.
+    '''
+    paths = [(nbfind.sort_key(path.rstrip("/") or "/", os.path.isdir(path)), path)
+             for path in opts.files or [opts.dir]]
+
+    for (_, path) in sorted(paths):
+        if os.path.isdir(path):
+            yield from nbfind.find(path, opts.include, opts.exclude)
+        else:
+            yield path
 
 
 def main():
     '''
     main programm
     '''
-    global opts
+    # answered before anything else is loaded
+    if sys.argv[1:] == ["--version"]:
+        version()
+
+    global opts, cache, profile
     opts = parse_arguments()
+    profile = open_profile(opts)
 
-    files = []
-    if opts.files == []:
-        for dpath, _, filenames in os.walk(opts.dir):
-            for fname in filenames:
-                if fname[-3:] == '.py':
-                    files.append(dpath + '/' + fname)
-    else:
-        files = opts.files
+    if opts.watch or opts.serve:
+        cache = open_cache(opts)
+        try:
+            if opts.watch:
+                watch()
+            else:
+                serve()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
 
-    debug(4, "files: %r" % files)
+    files = find_files()
+
+    # the daemon writes plain notebooks, the other modes need the parser
+    if opts.client and not (opts.check or opts.details or opts.merge or opts.profile):
+        results = convert_remote(files)
+
+        if results is not None:
+            if opts.update or any(results):
+                report_batch(results)
+            sys.exit(1 if 1 in results else 0)
+
+    # the daemon has its own cache, a client only opens it without one
+    cache = open_cache(opts)
+
+    if opts.check:
+        sys.exit(1 if check_all(files) else 0)
+
+    if opts.jobs > 1:
+        errors = convert_all(files)
+        report_profile()
+        report_cache()
+        sys.exit(1 if errors else 0)
 
     #
     debug(4, "create parser")
-    parser = pyparser.Parser(debuglevel=debuglevel)
+    parser = new_parser()
+
+    # a file that fails is reported and the batch goes on
+    results = []
+    for fname in files:
+        try:
+            results.append(convert(parser, fname))
+        except Exception as err:
+            print("ERROR: converting %s: %s: %s" % (fname, type(err).__name__, err))
+            results.append(1)
+
+        profile.done(fname)
+
+    if opts.update or any(results):
+        report_batch(results)
+
+    report_profile()
+    report_cache()
 
-    for fname in opts.files:
-        convert(parser, fname)
+    if 1 in results:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,223 @@
+"""
+    Find
+    ~~~~
+
+    Source file discovery for nbconvert.
+
+    The tree is walked with os.scandir, directories are pruned before they
+    are entered: version control and cache directories, virtualenvs,
+    node_modules, build directories, paths ignored by a .gitignore and
+    paths matching an --exclude glob. Files are yielded as they are found,
+    in sorted path order, so conversion can start while the walk goes on
+    and results come out in the same order.
+
+    .gitignore support covers the common syntax: comments, blank lines,
+    negation with !, directory patterns with a trailing /, patterns
+    anchored by a /, and the * ? [...] and ** wildcards.
+
+    :license: BSD.
+"""
+
+import os
+import re
+import fnmatch
+
+# directory names that are never walked
+PRUNE = {
+    ".git", ".hg", ".svn", ".bzr",
+    "__pycache__", ".mypy_cache", ".pytest_cache", ".tox", ".nox", ".eggs",
+    "node_modules", "site-packages",
+    "venv", ".venv",
+    "build", "dist",
+}
+
+# a directory with this file is a virtualenv, whatever its name
+VIRTUALENV = "pyvenv.cfg"
+
+
+def translate(pattern):
+    '''
+    Return the regular expression of a .gitignore glob, * and ? do not
+    match /, ** matches any number of directories
+    '''
+    regex = []
+    idx = 0
+
+    while idx < len(pattern):
+        char = pattern[idx]
+
+        if pattern[idx:idx + 3] == "**/":
+            regex.append("(?:.*/)?")
+            idx += 3
+            continue
+
+        if pattern[idx:idx + 2] == "**":
+            regex.append(".*")
+            idx += 2
+            continue
+
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[":
+            end = pattern.find("]", idx + 1)
+            if end < 0:
+                regex.append(re.escape(char))
+            else:
+                regex.append("[" + pattern[idx + 1:end].replace("!", "^", 1) + "]")
+                idx = end
+        else:
+            regex.append(re.escape(char))
+
+        idx += 1
+
+    return re.compile("".join(regex) + r"\Z")
+
+
+class Ignore():
+    '''
+    The patterns of one .gitignore, relative to its directory
+    '''
+
+    def __init__(self, lines):
+        # (regex, negate, directories only, anchored)
+        self.rules = []
+
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if line == "" or line[0] == "#":
+                continue
+
+            negate = line[0] == "!"
+            if negate:
+                line = line[1:]
+
+            dironly = line[-1:] == "/"
+            line = line.rstrip("/")
+
+            # a / anywhere but at the end anchors the pattern to the
+            # directory of the .gitignore
+            anchored = "/" in line
+            line = line.lstrip("/")
+
+            if line:
+                self.rules.append((translate(line), negate, dironly, anchored))
+
+    @classmethod
+    def read(cls, dirname):
+        '''
+        Return the Ignore of the .gitignore in dirname, None if there is none
+        '''
+        try:
+            with open(os.path.join(dirname, ".gitignore"), encoding='utf-8',
+                      errors='replace') as f:
+                return cls(f)
+        except OSError:
+            return None
+
+    def match(self, relpath, is_dir, ignored=False):
+        '''
+        Return whether relpath (relative to the .gitignore, / separated) is
+        ignored, the last matching pattern wins
+        '''
+        name = relpath.rsplit("/", 1)[-1]
+
+        for (regex, negate, dironly, anchored) in self.rules:
+            if dironly and not is_dir:
+                continue
+
+            if regex.match(relpath if anchored else name):
+                ignored = not negate
+
+        return ignored
+
+
+def matches(relpath, patterns):
+    '''
+    Return whether the path relative to the walked root or its name
+    matches one of the glob patterns
+    '''
+    name = os.path.basename(relpath)
+
+    for pattern in patterns:
+        if fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(name, pattern):
+            return True
+
+    return False
+
+
+def sort_key(name, is_dir):
+    '''
+    Return the sort key of a directory entry: directories sort as name/,
+    so walking them in place yields the paths in sorted path order
+    '''
+    return name + "/" if is_dir else name
+
+
+def find(root, include=("*.py",), exclude=(), gitignore=True):
+    '''
+    Yield the files below root matching an include glob in sorted path
+    order, see the module docstring for the pruned directories
+    '''
+    # explicit stack of open directories as (iterator of the remaining
+    # sorted entries, path relative to root, active .gitignores as (Ignore,
+    # path of its directory relative to root)), a directory is walked where
+    # it sorts among the files
+    stack = []
+
+    def enter(dirname, reldir, ignores):
+        if gitignore:
+            ignore = Ignore.read(dirname)
+            if ignore is not None:
+                ignores = ignores + [(ignore, reldir)]
+
+        entries = []
+
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+                    entries.append((sort_key(entry.name, is_dir), entry, is_dir))
+        except OSError:
+            return
+
+        entries.sort(key=lambda item: item[0])
+
+        stack.append((iter(entries), reldir, ignores))
+
+    enter(root, "", [])
+
+    while stack:
+        (entries, reldir, ignores) = stack[-1]
+
+        (_, entry, is_dir) = next(entries, (None, None, None))
+        if entry is None:
+            stack.pop()
+            continue
+
+        name = entry.name
+        relpath = reldir + "/" + name if reldir else name
+
+        if is_dir and name in PRUNE:
+            continue
+
+        if exclude and matches(relpath, exclude):
+            continue
+
+        ignored = False
+        for (ignore, base) in ignores:
+            ignored = ignore.match(relpath[len(base) + 1:] if base else relpath,
+                                   is_dir, ignored)
+        if ignored:
+            continue
+
+        if is_dir:
+            if not os.path.exists(os.path.join(entry.path, VIRTUALENV)):
+                enter(entry.path, relpath, ignores)
+        elif matches(relpath, include):
+            yield entry.path
@@ -0,0 +1,273 @@
+"""
+    Profile
+    ~~~~~~~
+
+    Per stage timings and visitor histograms for --profile.
+
+    Stages are timed exclusive of the stages nested in them, the notebook
+    writer pulls the cells from the parser, so "write" is only the time
+    spent writing. The statements are counted per node type as segment()
+    tags them, or per keyword for code segmented from its tokens. With
+    --details the visitor handlers are counted with their own time and
+    their cumulative time, recursive calls of a handler count once for
+    the cumulative time.
+
+    Profiling is off by default: nbconvert then uses its DISABLED profile,
+    which times nothing, and runs the plain Parser, so the per node cost is
+    zero and the per file cost a few calls. This module is only loaded with
+    --profile.
+
+    :license: BSD.
+"""
+
+import json
+import time
+import contextlib
+
+from ast import Constant
+
+import pyparser
+
+STAGES = ["read", "Parser.load", "ast.parse", "Parser.visit", "Parser.segment",
+          "Parser.notebook", "Notebook.cell", "write"]
+
+clock = time.perf_counter
+
+
+class Profile():
+
+    enabled = True
+
+    def __init__(self):
+        # (file name, stage -> seconds) of the finished files
+        self.files = []
+        self.stages = {}
+
+        # handler -> [calls, own seconds, cumulative seconds]
+        self.handlers = {}
+
+        # statement node type or token keyword -> count
+        self.statements = {}
+
+        # time of the nested stages and handlers of the running ones
+        self.nested = []
+        self.visits = []
+
+        # handler -> running calls
+        self.active = {}
+
+    def stop(self, nested, start):
+        '''
+        Return the elapsed and own time of a timer started at start
+        '''
+        elapsed = clock() - start
+        inner = nested.pop()
+
+        if nested:
+            nested[-1] += elapsed
+
+        return (elapsed, elapsed - inner)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Time the block as stage name
+        '''
+        self.nested.append(0.0)
+        start = clock()
+
+        try:
+            yield
+        finally:
+            self.add(name, self.stop(self.nested, start)[1])
+
+    def timed(self, name, iterable):
+        '''
+        Yield the items of iterable, the time spent producing them counts
+        for stage name
+        '''
+        it = iter(iterable)
+
+        while True:
+            self.nested.append(0.0)
+            start = clock()
+
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.add(name, self.stop(self.nested, start)[1])
+
+            yield item
+
+    def count(self, name):
+        '''
+        Count a segmented statement
+        '''
+        self.statements[name] = self.statements.get(name, 0) + 1
+
+    def visit(self, name, method, *args):
+        '''
+        Run a visitor handler and count it
+        '''
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = [0, 0.0, 0.0]
+
+        depth = self.active.get(name, 0)
+        self.active[name] = depth + 1
+
+        self.visits.append(0.0)
+        start = clock()
+
+        try:
+            return method(*args)
+        finally:
+            (elapsed, own) = self.stop(self.visits, start)
+
+            self.active[name] = depth
+            stats[0] += 1
+            stats[1] += own
+            if depth == 0:
+                stats[2] += elapsed
+
+    def done(self, filename):
+        '''
+        Finish the stages of a file
+        '''
+        self.files.append((filename, self.stages))
+        self.stages = {}
+
+    def data(self):
+        '''
+        Return the profile as JSON compatible dict
+        '''
+        total = {}
+        files = []
+
+        for (filename, stages) in self.files:
+            for (name, seconds) in stages.items():
+                total[name] = total.get(name, 0.0) + seconds
+
+            files.append({"file": filename, "stages": stages,
+                          "total": sum(stages.values())})
+
+        handlers = {}
+        for (name, (calls, own, cumulative)) in self.handlers.items():
+            handlers[name] = {"calls": calls, "self": own, "cumulative": cumulative}
+
+        return {"files": files, "stages": total, "total": sum(total.values()),
+                "statements": dict(self.statements), "handlers": handlers}
+
+    def merge(self, data):
+        '''
+        Add the files and handlers of a data() dict, from a worker process
+        '''
+        for entry in data["files"]:
+            self.files.append((entry["file"], entry["stages"]))
+
+        for (name, entry) in data["handlers"].items():
+            stats = self.handlers.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += entry["calls"]
+            stats[1] += entry["self"]
+            stats[2] += entry["cumulative"]
+
+        for (name, calls) in data["statements"].items():
+            self.statements[name] = self.statements.get(name, 0) + calls
+
+    def collect(self):
+        '''
+        Return data() and start over
+        '''
+        data = self.data()
+        self.__init__()
+
+        return data
+
+    def report(self, f, fmt="table"):
+        '''
+        Write the profile as table or json to f
+        '''
+        data = self.data()
+
+        if fmt == "json":
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write("\n")
+            return
+
+        stages = [name for name in STAGES if name in data["stages"]]
+        row = "%-32s" + " %15s" * (len(stages) + 1) + "\n"
+
+        f.write(row % tuple(["file (ms)"] + stages + ["total"]))
+        for entry in data["files"]:
+            f.write(row % tuple([entry["file"][-32:]] +
+                                ["%.3f" % (entry["stages"].get(name, 0.0) * 1e3)
+                                 for name in stages] +
+                                ["%.3f" % (entry["total"] * 1e3)]))
+        f.write(row % tuple(["total"] +
+                            ["%.3f" % (data["stages"][name] * 1e3) for name in stages] +
+                            ["%.3f" % (data["total"] * 1e3)]))
+
+        if data["statements"]:
+            f.write("\n%-32s %10s\n" % ("statement", "count"))
+            for (name, calls) in sorted(data["statements"].items(),
+                                        key=lambda item: (-item[1], item[0])):
+                f.write("%-32s %10d\n" % (name, calls))
+
+        if not data["handlers"]:
+            return
+
+        f.write("\n%-32s %10s %12s %12s\n" % ("handler", "calls", "self ms", "cumul ms"))
+        for (name, entry) in sorted(data["handlers"].items(),
+                                    key=lambda item: -item[1]["self"]):
+            f.write("%-32s %10d %12.3f %12.3f\n" % (
+                name, entry["calls"], entry["self"] * 1e3, entry["cumulative"] * 1e3))
+
+
+class ProfileParser(pyparser.Parser):
+    '''
+    Parser that times its stages and counts its statements and visitor
+    handlers into a Profile
+    '''
+
+    def __init__(self, profile, **kwargs):
+        super().__init__(**kwargs)
+        self.profile = profile
+        self.counter = profile.count
+
+    def load(self, source):
+        with self.profile.stage("Parser.load"):
+            super().load(source)
+
+    def parse_code(self, code):
+        with self.profile.stage("ast.parse"):
+            return super().parse_code(code)
+
+    def generate(self, tree):
+        with self.profile.stage("Parser.visit"):
+            super().generate(tree)
+
+    def segment(self, tree):
+        with self.profile.stage("Parser.segment"):
+            super().segment(tree)
+
+    def segment_tokens(self):
+        with self.profile.stage("Parser.segment"):
+            super().segment_tokens()
+
+    def notebook(self, rows=None):
+        return self.profile.timed("Parser.notebook", super().notebook(rows))
+
+    def visit(self, node):
+        if node.__class__ is Constant:
+            entry = self.constants.get(type(node.value), self.constants[int])
+        else:
+            entry = self.dispatch.get(node.__class__)
+
+        name = entry[0].__name__ if entry is not None else "generic_visit"
+
+        return self.profile.visit(name, super().visit, node)
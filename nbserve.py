@@ -0,0 +1,113 @@
+"""
+    Serve
+    ~~~~~
+
+    Conversion daemon for --serve, nbclient connects to it.
+
+    The daemon listens on a Unix socket and keeps its interpreter, the
+    imported converter and a parser per connection thread warm. Requests
+    and responses are JSON objects in frames of a 4 byte big endian length
+    followed by the UTF-8 encoded JSON text. A connection may carry any
+    number of requests:
+
+        {"path": "/abs/file.py"}                       convert a file
+        {"source": "...", "filename": "file.py"}       convert source text
+
+        {"notebook": "..."}                            notebook JSON text
+        {"notebook": "...", "fallback": "parsing ..."} converted from its
+                                                       tokens, it does not parse
+        {"error": "SyntaxError: ..."}                  conversion failed
+
+    A path request may name the file as the client knows it with
+    "filename". With "strict": true code that does not parse fails
+    instead of being converted from its tokens.
+
+    The socket is only accessible by its owner.
+
+    :license: BSD.
+"""
+
+import os
+import socketserver
+
+from nbclient import Client, receive, send
+
+
+class Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        # kept for the connection, the parser of its thread
+        state = {}
+
+        while True:
+            message = receive(self.request)
+            if message is None:
+                return
+
+            send(self.request, self.server.respond(message, state))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Conversion daemon, convert(source, filename, state, stat, strict)
+    returns the notebook JSON text of source (str or bytes) and the parse
+    error if it was converted from its tokens, else None. state is a dict
+    kept for the connection and stat the os.stat_result of a file read,
+    else None.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path, convert):
+        self.path = path
+        self.convert = convert
+
+        # a stale socket of a daemon that is gone is replaced
+        if os.path.exists(path):
+            try:
+                Client(path).close()
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError("daemon already running on %s" % path)
+
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(umask)
+
+    def respond(self, message, state):
+        '''
+        Return the response to a request message
+        '''
+        try:
+            stat = None
+
+            if "path" in message:
+                filename = message.get("filename", message["path"])
+                with open(message["path"], 'rb') as f:
+                    stat = os.fstat(f.fileno())
+                    source = f.read()
+            else:
+                filename = message.get("filename", "<string>")
+                source = message["source"]
+
+            (notebook, fallback) = self.convert(source, filename, state, stat,
+                                                bool(message.get("strict")))
+
+            if fallback is not None:
+                return {"notebook": notebook, "fallback": fallback}
+
+            return {"notebook": notebook}
+
+        except Exception as err:
+            return {"error": "%s: %s" % (type(err).__name__, err)}
+
+    def server_close(self):
+        super().server_close()
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,141 @@
+"""
+    Watch
+    ~~~~~
+
+    Change detection for the --watch mode.
+
+    The watcher keeps an index of path -> (mtime, size, hash) of the source
+    files. A file counts as changed when it is new or its content hash
+    differs, the hash is only computed when mtime or size moved. Changes
+    are debounced: a batch is reported once a scan finds no further
+    changes, so a file that is still being written or a checkout touching
+    many files ends up in a single batch.
+
+    The tree is polled. With the optional inotify_simple package the
+    watcher sleeps on inotify events instead, and a poll still catches
+    new directories.
+
+    :license: BSD.
+"""
+
+import os
+import time
+import hashlib
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class Watch():
+
+    def __init__(self, discover, interval=1.0, debounce=0.5):
+        # discover() returns the paths to watch
+        self.discover = discover
+        self.interval = interval
+        self.debounce = debounce
+
+        # path -> (mtime, size, hash)
+        self.index = {}
+
+        self.inotify = None
+        self.watched = set()
+
+        if inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+            except OSError:
+                pass
+
+    def digest(self, path):
+        '''
+        Return the content hash of a file
+        '''
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def scan(self):
+        '''
+        Update the index, return the paths that are new or changed
+        '''
+        changed = []
+        seen = set()
+
+        for path in self.discover():
+            seen.add(path)
+
+            try:
+                st = os.stat(path)
+                entry = self.index.get(path)
+
+                if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+                    continue
+
+                digest = self.digest(path)
+            except OSError:
+                # removed while scanning, forgotten below
+                seen.discard(path)
+                continue
+
+            self.index[path] = (st.st_mtime_ns, st.st_size, digest)
+
+            if entry is None or entry[2] != digest:
+                changed.append(path)
+
+            self.watch(os.path.dirname(path) or '.')
+
+        for path in set(self.index) - seen:
+            del self.index[path]
+
+        return changed
+
+    def watch(self, dirname):
+        '''
+        Add an inotify watch for a directory
+        '''
+        if self.inotify is None or dirname in self.watched:
+            return
+
+        flags = inotify_simple.flags
+        try:
+            self.inotify.add_watch(dirname, flags.CLOSE_WRITE | flags.MOVED_TO |
+                                   flags.CREATE | flags.DELETE | flags.MOVED_FROM)
+            self.watched.add(dirname)
+        except OSError:
+            pass
+
+    def wait(self, timeout):
+        '''
+        Sleep for timeout seconds, or until an inotify event arrives
+        '''
+        if self.inotify is None:
+            time.sleep(timeout)
+        else:
+            self.inotify.read(timeout=int(timeout * 1000))
+
+    def batches(self):
+        '''
+        Yield the sorted list of changed paths, first all paths, then a
+        batch for every change once it settled
+        '''
+        yield sorted(self.scan())
+
+        while True:
+            self.wait(self.interval)
+
+            pending = set(self.scan())
+            if not pending:
+                continue
+
+            # debounce: collect until a scan finds nothing new
+            while True:
+                time.sleep(self.debounce)
+
+                changed = self.scan()
+                if not changed:
+                    break
+
+                pending.update(changed)
+
+            yield sorted(pending)
@@ -0,0 +1,43 @@
+"""
+    Debug
+    ~~~~~
+
+    Level gated debug output shared by nbconvert, pynotebook and pyparser.
+
+    Messages are passed args-style, debug(4, "read file: %s", filename), so
+    the string is only formatted and the calling function only looked up
+    when the message is actually printed.
+
+    :license: BSD.
+"""
+
+import sys
+
+
+class Debug():
+    '''
+    Callable debug logger
+
+    fmt is a %-format with the named fields call, level, debuglevel and line
+    '''
+
+    def __init__(self, debuglevel=0, fmt="DBG: %(call)-10s %(line)s"):
+        self.debuglevel = debuglevel
+        self.fmt = fmt
+
+    def enabled(self, level):
+        return level <= self.debuglevel
+
+    def __call__(self, level, line="", *args):
+        if level > self.debuglevel:
+            return
+
+        if args:
+            line = line % args
+
+        print(self.fmt % {
+            "call": sys._getframe(1).f_code.co_name,
+            "level": level,
+            "debuglevel": self.debuglevel,
+            "line": line
+        })
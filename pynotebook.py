@@ -2,99 +2,308 @@
 
 import os
 import sys
-import inspect
+import copy
+import json
+import hashlib
+
+import pydebug
+
+# JSON string literal of a str, as json.dumps but without its call overhead
+encode = json.encoder.encode_basestring_ascii
+
+
+def fingerprint(source):
+    '''
+    Return the fingerprint of a cell source text
+    '''
+    return hashlib.sha256(source.encode('utf-8')).digest()
 
 
 class Notebook():
+    '''
+    Streaming nbformat 4 writer
+
+    Source lines are collected for the current cell only, each finished
+    cell is returned as JSON text by cell() so memory stays bounded by the
+    largest cell. With linewise set, cell() returns the text of every line
+    as it comes and only holds one line, unless cells are kept (--merge).
+    '''
 
     debuglevel = 0
     isfirstcell = True
 
-    indent = ' \t'
+    indent = ' '
+
+    nbformat = 4
+    nbformat_minor = 0
+
+    metadata = {
+        "anaconda-cloud": {},
+        "kernelspec": {"display_name": "python3", "language": "python", "name": "python3"},
+        "language_info": {
+            "codemirror_mode": {"name": "ipython", "version": 3},
+            "file_extension": ".py",
+            "mimetype": "text/x-python",
+            "name": "python",
+            "nbconvert_exporter": "python",
+            "pygments_lexer": "ipython3",
+            "version": "3.4.2"
+        }
+    }
 
     def __init__(self, debuglevel=4):
         self.debuglevel = debuglevel
 
-    def debug(self, level, line):
-        '''
-        Write debug message to output
-        '''
+        # Write debug message to output
+        self.debug = pydebug.Debug(debuglevel)
+
+        # cell type and source lines of the cell being collected
+        self.celltype = None
+        self.source = []
+        self.cells = 0
+
+        # write the lines of a cell as they come, the last line of the open
+        # cell is held back for its missing newline
+        self.linewise = False
+        self.pending = None
 
-        call = inspect.stack()[1][3]
-        this = inspect.stack()[0][3]
+        # source fingerprint -> code cells of an existing notebook, see keep()
+        self.kept = {}
 
-        if level <= self.debuglevel:
-            print("DBG: %-10s %s" % (call, line))
+        # converter and source stamp, stored in the notebook metadata
+        self.stamp = None
+
+        # the cell fields are the same for every cell of a type
+        self.headers = {}
+        for celltype in ["C", "M"]:
+            self.headers[celltype] = json.dumps(self.header(celltype), sort_keys=True)[1:-1]
 
     def nb_start(self):
-        return '{\t"cells":\n\t[\n'
+        return '{\n' + self.indent + '"cells": [\n'
 
     def nb_end(self):
-        return ' \t],\n' \
-            ' \t"metadata": {\n' \
-            ' \t\t"anaconda-cloud": {},\n' \
-            ' \t\t"kernelspec": { "display_name": "python3", "language": "python", "name": "python3" },\n' \
-            ' \t\t"language_info": { "codemirror_mode": { \n' \
-            ' \t\t\t"name": "ipython", "version": 3 },\n' \
-            ' \t\t\t"file_extension": ".py",\n' \
-            ' \t\t\t"mimetype": "text/x-python",\n' \
-            ' \t\t\t"name": "python",\n' \
-            ' \t\t\t"nbconvert_exporter": "python",\n' \
-            ' \t\t\t"pygments_lexer": "ipython3",\n' \
-            ' \t\t\t"version": "3.4.2"\n' \
-            ' \t\t\t}\n' \
-            ' \t\t},' \
-            ' \t\t"nbformat": 4, "nbformat_minor": 0\n' \
-            '}'
+        return '\n' + self.indent + '],\n' + \
+            self.indent + '"metadata": ' + json.dumps(self.notebook_metadata(), sort_keys=True) + ',\n' + \
+            self.indent + '"nbformat": %d,\n' % self.nbformat + \
+            self.indent + '"nbformat_minor": %d\n' % self.nbformat_minor + \
+            '}\n'
+
+    def notebook_metadata(self):
+        '''
+        Return the notebook metadata, with the stamp if set
+        '''
+        if self.stamp is None:
+            return self.metadata
+
+        return dict(self.metadata, nbconvert=self.stamp)
+
+    def header(self, celltype):
+        '''
+        Return the cell fields besides source
+        '''
+        if celltype == "C":
+            return {
+                "cell_type": "code",
+                "execution_count": 2,
+                "metadata": {"collapsed": False},
+                "outputs": []
+            }
+
+        return {
+            "cell_type": "markdown",
+            "metadata": {}
+        }
+
+    def keep(self, notebook):
+        '''
+        Index the code cells of an existing notebook dict that have outputs
+        or an execution count by source fingerprint. Code cells written
+        later with the same source keep them, matched in document order.
+
+        Returns the number of indexed cells.
+        '''
+        default = self.header("C")
+        count = 0
+
+        self.kept = {}
+        for cell in notebook.get("cells", []):
+            if cell.get("cell_type") != "code":
+                continue
+
+            if cell.get("outputs", []) == default["outputs"] and \
+                    cell.get("execution_count") == default["execution_count"]:
+                continue
+
+            source = cell.get("source", "")
+            if isinstance(source, list):
+                source = ''.join(source)
+
+            self.kept.setdefault(fingerprint(source), []).append(cell)
+            count += 1
+
+        # pop() returns the first cell of the same source
+        for cells in self.kept.values():
+            cells.reverse()
+
+        return count
+
+    def kept_fields(self):
+        '''
+        Return the cell fields besides source of the collected cell, with
+        outputs and execution count of the matching kept cell
+        '''
+        fields = self.header(self.celltype)
+
+        if self.celltype != "C" or not self.kept:
+            return fields
+
+        cells = self.kept.get(fingerprint('\n'.join(self.source)))
+        if cells:
+            cell = cells.pop()
+
+            fields["execution_count"] = cell.get("execution_count")
+            fields["outputs"] = cell.get("outputs", [])
+
+        return fields
+
+    def append(self, change, celltype, line):
+        '''
+        Add a source line, change starts a new cell
+        '''
+        if change or self.celltype is None:
+            self.celltype = celltype
+
+        if celltype == "M" and line == "":
+            line = " "
+
+        self.source.append(line)
+
+        return line
+
+    def celldict(self):
+        '''
+        Return the collected cell as nbformat dict
+        '''
+        cell = self.kept_fields()
+        cell["source"] = [line + "\n" for line in self.source[:-1]] + self.source[-1:]
+
+        self.cells += 1
+        self.source = []
+
+        return cell
+
+    def document(self, cells):
+        '''
+        Return the nbformat dict of a notebook with cells
+        '''
+        return {
+            "cells": cells,
+            "metadata": copy.deepcopy(self.notebook_metadata()),
+            "nbformat": self.nbformat,
+            "nbformat_minor": self.nbformat_minor
+        }
+
+    def celldicts(self, lines):
+        '''
+        Group (change, celltype, line) triples into nbformat cell dicts, a
+        line None ends the notebook
+        '''
+        for (change, celltype, line) in lines:
+            if (change or line is None) and self.source:
+                yield self.celldict()
+
+            if line is not None:
+                self.append(change, celltype, line)
+
+    def dump(self):
+        '''
+        Return the collected cell as JSON text
+        '''
+        indent = self.indent * 2
+        source = self.source
+
+        # every source line but the last keeps its newline
+        lines = [encode(line + "\n") for line in source[:-1]]
+        lines.append(encode(source[-1]))
+
+        if self.kept:
+            header = json.dumps(self.kept_fields(), sort_keys=True)[1:-1]
+        else:
+            header = self.headers[self.celltype]
+
+        content = ",\n" if self.cells else ""
+        content += indent + "{" + header + \
+            ',\n' + indent + self.indent + '"source": [\n' + \
+            indent + self.indent * 2 + (",\n" + indent + self.indent * 2).join(lines) + \
+            '\n' + indent + self.indent + ']\n' + indent + '}'
+
+        self.cells += 1
+        self.source = []
+
+        return content
+
+    def line(self, change, celltype, line):
+        '''
+        Return the JSON text of a source line for cell() with linewise set,
+        the same text dump() writes for the whole cell
+        '''
+        indent = self.indent * 2
+        content = ""
+
+        if self.pending is not None:
+            if change or line is None:
+                content = encode(self.pending) + '\n' + indent + self.indent + ']\n' + indent + '}'
+                self.pending = None
+                self.cells += 1
+            else:
+                content = encode(self.pending + "\n") + ",\n" + indent + self.indent * 2
+
+        if line is None:
+            return content
+
+        if self.pending is None:
+            self.celltype = celltype
+
+            content += ",\n" if self.cells else ""
+            content += indent + "{" + self.headers[celltype] + \
+                ',\n' + indent + self.indent + '"source": [\n' + indent + self.indent * 2
+
+        if celltype == "M" and line == "":
+            line = " "
+
+        self.pending = line
+
+        return content
 
     def cell(self, change, celltype, line):
         '''
-        write a code cell:
-        type = 'code' or 'markdown'
+        add a source line:
+        change starts a new cell of celltype = 'C' (code) or 'M' (markdown),
+        line None ends the notebook.
+
+        Returns the JSON text of the notebook header and the cells finished
+        by this line.
         '''
 
-        self.debug(2, "change: %s/%s first: %r line: '%s'" %
-                   (change, celltype, 1 if self.isfirstcell else 0, line))
+        self.debug(2, "change: %s/%s first: %r line: '%s'",
+                   change, celltype, 1 if self.isfirstcell else 0, line)
 
-        info = "c: %s t: %s f: %r" % (change, celltype, self.isfirstcell)
         content = ""
 
         if self.isfirstcell:
             content = self.nb_start()
-        else:
-            if change:
-                content += "\"\n" + self.indent * 3 + "]\n" + self.indent * 2 + "}"
-            else:
-                content += "\\n\"" 
-            content += ",\n"
 
-        if celltype == "C":
-            typ = "code"
-        elif celltype == "M":
-            typ = "markdown"
-            if line == "":
-                line = " "
-
-        if change:
-            content += self.indent * 2 + \
-                "{" + self.indent + "\"cell_type\": \"" + typ + "\", "
-
-            if typ == "code":
-                content += "\"execution_count\": 2, \"metadata\": { \"collapsed\": false }, \"outputs\": []"
-            else:
-                content += "\"metadata\": {}"
-
-            content += ", \n" + self.indent * 3 + "\"source\": [\n"
+        if self.linewise and not self.kept:
+            content += self.line(change, celltype, line)
+        elif (change or line is None) and self.source:
+            content += self.dump()
 
         if line is None:
-            content = "\"\n" 
-            content += self.indent * 3 + "]\n" + self.indent * 2 + "}" + "\n"
             content += self.nb_end()
-        else:
-            line = line.replace('"', '\\\"')
-            content += self.indent * 4 + "\"" + str(line)
+        elif not self.linewise or self.kept:
+            line = self.append(change, celltype, line)
 
-        self.debug(2, " %19s line: '%s'" % (" ", line))
+        self.debug(2, " %19s line: '%s'", " ", line)
         #
         self.isfirstcell = False
 
@@ -10,12 +10,20 @@
     :license: BSD.
 """
 
+import io
 import os
-import inspect
+import re
+import sys
+import tokenize
+import threading
 
 import ast
+from array import array
 from ast import *
 
+import pydebug
+import pysource
+
 BINOP_SYMBOLS = {}
 BINOP_SYMBOLS[Add] = '+'
 BINOP_SYMBOLS[Sub] = '-'
@@ -29,6 +37,7 @@ BINOP_SYMBOLS[BitOr] = '|'
 BINOP_SYMBOLS[BitXor] = '^'
 BINOP_SYMBOLS[BitAnd] = '&'
 BINOP_SYMBOLS[FloorDiv] = '//'
+BINOP_SYMBOLS[MatMult] = '@'
 
 BOOLOP_SYMBOLS = {}
 BOOLOP_SYMBOLS[And] = 'and'
@@ -121,164 +130,491 @@ PYTHON_ELEMENTS = {
         , "with": 1
         , "write": 0
         , "yield": 0
+
+        , "annassign": 0
+        , "arg": 0
+        , "await": 0
+        , "index": 0
+        , "joinedstr": 0
+        , "keyword": 0
+        , "match": 0
+        , "match_case": 0
+        , "matchas": 0
+        , "matchclass": 0
+        , "matchmapping": 0
+        , "matchor": 0
+        , "matchsequence": 0
+        , "matchsingleton": 0
+        , "matchstar": 0
+        , "matchvalue": 0
+        , "nameconstant": 0
+        , "namedexpr": 0
+        , "paramspec": 0
+        , "try": 0
+        , "typealias": 0
+        , "typevar": 0
+        , "typevartuple": 0
+        , "withitem": 0
+        , "yieldfrom": 0
 }
 
+# line tags are bitmasks: TAG_LINE marks a tagged line, every
+# PYTHON_ELEMENTS key with value 1 has its own bit
+TAG_LINE = 1
+
+TAGS = {}
+for key in PYTHON_ELEMENTS:
+    if PYTHON_ELEMENTS[key] == 1:
+        TAGS[key] = 1 << (len(TAGS) + 1)
+del key
+
+CLASS_ENTER = TAGS["class_enter"]
+CLASS_EXIT = TAGS["class_exit"]
+FUNC_ENTER = TAGS["func_enter"]
+FUNC_EXIT = TAGS["func_exit"]
+
+# statement type -> tag bit of its PYTHON_ELEMENTS key
+STATEMENT_TAGS = {}
+for cls in [Assign, AugAssign, AnnAssign, Expr, For, AsyncFor, If, Import, ImportFrom,
+            Pass, Return, While, With, AsyncWith, FunctionDef, AsyncFunctionDef, ClassDef]:
+    STATEMENT_TAGS[cls] = TAGS.get(cls.__name__.lower().replace("async", ""), 0)
+del cls
+
+# statements marked with class/func_enter and class/func_exit
+DEFINITIONS = (ClassDef, FunctionDef, AsyncFunctionDef)
+
+# compound statement type -> its statement lists, in source order
+BLOCK_FIELDS = {}
+for base in [stmt, excepthandler]:
+    for cls in base.__subclasses__():
+        fields = [field for field in ("body", "handlers", "orelse", "finalbody", "cases")
+                  if field in cls._fields]
+        if fields:
+            BLOCK_FIELDS[cls] = tuple(fields)
+del base, cls, fields
+
+# first keyword of a logical line -> tag bit, see segment_tokens()
+KEYWORD_TAGS = {}
+for (word, key) in [("class", "classdef"), ("def", "functiondef"), ("for", "for"),
+                    ("if", "if"), ("elif", "if"), ("import", "import"),
+                    ("from", "importfrom"), ("pass", "pass"), ("print", "print"),
+                    ("return", "return"), ("while", "while"), ("with", "with")]:
+    KEYWORD_TAGS[word] = TAGS[key]
+del word, key
+
+# statement keywords tagged like the statements without a tag of their own
+STATEMENT_KEYWORDS = {"assert", "break", "continue", "del", "except", "finally", "global",
+                      "nonlocal", "raise", "try", "else", "elif", "case", "match", "exec"}
+
+# clauses continuing the compound statement of the block before them
+CLAUSES = {"elif", "else", "except", "finally"}
+CLAUSE = re.compile(r"(elif|else|except|finally)\b")
+
+# first characters of lines that do not start a top-level statement
+STATEMENT_INDENT = ("", " ", "\t", "\f", "#")
+
+# errors of code that segment_tokens() converts instead
+PARSE_ERRORS = (SyntaxError, ValueError, RecursionError)
+
+# CPython 3.11 builds the ast objects recursively under the interpreter
+# recursion limit, three levels per unit of the limit, and long operator
+# chains like 'a' + 'a' + ... nest one level per operand. There, code too
+# deep for the default limit is parsed again in a thread with a stack of
+# DEEP_STACK_SIZE and the limit raised to what fits in it: a level takes
+# about 80 bytes of C stack, 256 are assumed. Deeper code raises
+# RecursionError instead of overflowing the stack. Later versions check a
+# fixed C recursion limit of their own, raising the interpreter limit
+# does not help and deep code raises RecursionError at once.
+DEEP_PARSE = sys.version_info[:2] == (3, 11)
+DEEP_STACK_SIZE = 64 * 1024 * 1024
+AST_RECURSION_LIMIT = DEEP_STACK_SIZE // (3 * 256)
+
+# the recursion limit is global to the interpreter: while it is raised no
+# other thread may build an ast on its own stack
+ast_lock = threading.Lock()
+
+def tag_names(tags):
+    '''
+    Return the PYTHON_ELEMENTS keys of a line tag bitmask
+    '''
+    return [key for key in TAGS if tags & TAGS[key]]
+
+def parse_tree(source, filename="<unknown>"):
+    '''
+    Return the ast of source (str or bytes), see DEEP_STACK_SIZE for deeply
+    nested code
+    '''
+    # ast.parse holds the GIL, the lock costs no parallelism
+    with ast_lock:
+        try:
+            return ast.parse(source, filename)
+        except RecursionError:
+            if not DEEP_PARSE:
+                raise
+        except MemoryError as err:
+            # the parser gives up on code too complex for its own stack,
+            # like a long elif ladder, with a MemoryError
+            raise SyntaxError("source too complex to parse") from err
+
+        return parse_deep(source, filename)
+
+def parse_deep(source, filename):
+    '''
+    Return the ast of deeply nested source, parsed in a thread with a stack
+    of DEEP_STACK_SIZE under AST_RECURSION_LIMIT. Call with ast_lock held.
+    '''
+    result = []
+
+    def run():
+        try:
+            result.append(ast.parse(source, filename))
+        except BaseException as err:
+            result.append(err)
+
+    limit = sys.getrecursionlimit()
+    size = threading.stack_size(DEEP_STACK_SIZE)
+
+    try:
+        thread = threading.Thread(target=run, name="parse_deep")
+        sys.setrecursionlimit(max(limit, AST_RECURSION_LIMIT))
+        thread.start()
+        thread.join()
+    finally:
+        sys.setrecursionlimit(limit)
+        threading.stack_size(size)
+
+    if isinstance(result[0], BaseException):
+        raise result[0]
+
+    return result[0]
+
+def skip_hashbang(lines, skipped=None):
+    '''
+    Yield the lines but hashbang lines and the blank lines following them,
+    the indexes of the dropped lines are appended to the list skipped
+    '''
+    ignoreLine=False
+
+    for (index, line) in enumerate(lines):
+        if line[0:2] == '#!':
+            ignoreLine = True
+        elif ignoreLine and line == "":
+            pass
+        else:
+            yield line
+            ignoreLine = False
+            continue
+
+        if skipped is not None:
+            skipped.append(index)
+
+def skip(*args, **kwargs):
+    '''
+    Replaces Parser.write and Parser.newline when no source is regenerated
+    '''
+    pass
+
+def element(key):
+    '''
+    Bind the PYTHON_ELEMENTS key of a helper that is not dispatched by
+    Parser.visit (body, signature, ...)
+    '''
+    def decorate(method):
+        def wrapper(self, *args, **kwargs):
+            outer = self.key
+            self.key = key
+
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.key = outer
+
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+
+        return wrapper
+    return decorate
+
+class Context():
+    '''
+    State of one conversion: source lines, line tags, regenerated code and
+    the visitor state. Parser.parse() resets it for every file.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.code = []
+        self.result = []
+        self.stack = []
+
+        # per line tag bitmask and class/function nesting, see allocate()
+        self.tags = array('I')
+        self.classes = array('H')
+        self.funcs = array('H')
+
+        # the parse error of code segmented from its tokens
+        self.error = None
+
+        # indexes of the source lines skip_hashbang() dropped from code
+        self.skipped = []
+
+        self.indentation = 0
+        self.new_lines = 0
+
+    def allocate(self):
+        '''
+        Size the line tables to the source code
+        '''
+        size = len(self.code)
+
+        self.tags = array('I', [0]) * size
+        self.classes = array('H', [0]) * size
+        self.funcs = array('H', [0]) * size
+
+    def source_line(self, lineno):
+        '''
+        Return the source line number of line number lineno of code
+        '''
+        for index in self.skipped:
+            if index >= lineno:
+                break
+            lineno += 1
+
+        return lineno
+
+    def locate(self, err):
+        '''
+        Move the line numbers of a syntax error in code to the source lines,
+        the message may name a line too
+        '''
+        if not isinstance(err, SyntaxError) or err.lineno is None or not self.skipped:
+            return
+
+        err.lineno = self.source_line(err.lineno)
+        if err.end_lineno is not None:
+            err.end_lineno = self.source_line(err.end_lineno)
+
+        if err.msg:
+            err.msg = re.sub(r'\bon line (\d+)',
+                             lambda m: "on line %d" % self.source_line(int(m.group(1))),
+                             err.msg)
+
+    def describe(self, lineno):
+        '''
+        Return the tag names and nesting of a line
+        '''
+        return tag_names(self.tags[lineno]) + [
+            "%s=%d" % (KEY_CLASS_COUNT, self.classes[lineno]),
+            "%s=%d" % (KEY_FUNC_COUNT, self.funcs[lineno])
+        ]
+
 class Parser(NodeVisitor):
     """
-    This visitor is able to transform a well formed syntax tree into python
-    sourcecode.  For more details have a look at the docstring of the
-    `node_to_source` function.
+    This visitor tags the source lines of a well formed syntax tree with the
+    python elements they belong to. With regenerate=True it also transforms
+    the tree back into python sourcecode (result). For more details have a
+    look at the docstring of the `node_to_source` function.
     """
 
     (STATE_IGNORE, STATE_ENTER, STATE_EXIT) = [ "ignore", "enter", "exit" ] # range(3)
 
     debuglevel = 0
-    lineno = -1
 
-    state = {}
-    stack = []
-    lines = {}
-    result = []
-
-    in_classdef = 0
-    in_funcdef = 0
-
-    def __init__(self, indent_with=' ' * 4, add_line_information=False, debuglevel=4):
-        self.result = []
-        self.state = {}
-        self.stack=[]
+    # PYTHON_ELEMENTS key of the visitor currently running
+    key = None
+
+    # node type -> (visitor function, PYTHON_ELEMENTS key), see build_dispatch()
+    dispatch = {}
+
+    # Constant value type -> (visitor function, PYTHON_ELEMENTS key)
+    constants = {}
+
+    # node types handled by the visitor of another type
+    ALIASES = {
+        "AsyncFunctionDef": "FunctionDef",
+        "AsyncFor": "For",
+        "AsyncWith": "With",
+        "ExceptHandler": "excepthandler",
+        "TryStar": "Try",
+    }
+
+    # Constant value types and the visitor of their pre 3.8 node type
+    CONSTANTS = {
+        bool: "NameConstant",
+        type(None): "NameConstant",
+        int: "Num",
+        float: "Num",
+        complex: "Num",
+        str: "Str",
+        bytes: "Bytes",
+        type(...): "Ellipsis",
+    }
+
+    except_keyword = 'except'
+
+    # called with the node type name of every statement segment() tags and
+    # with "token " and the keyword of every logical line segment_tokens()
+    # tags, see nbprofile
+    counter = None
+
+    def __init__(self, indent_with=' ' * 4, add_line_information=False, debuglevel=4,
+                 regenerate=False, fallback=False):
+        self.context = Context()
         self.indent_with = indent_with
         self.add_line_information = add_line_information
         self.debuglevel = debuglevel
-        self.indentation = 0
-        self.new_lines = 0
+        self.regenerate = regenerate
 
-    def debug(self, level, line=""):
-        call = inspect.stack()[1][3]
-        this = inspect.stack()[0][3] 
+        # code that does not parse is segmented from its tokens instead of
+        # raising the parse error
+        self.fallback = fallback
 
-        if level <= self.debuglevel:
-            print("DBG: %s" % line)
+        # the notebook only needs the line tags, regenerating the source
+        # into result is only done on request (--details)
+        if not regenerate:
+            self.write = skip
+            self.newline = skip
 
-    def setstate(self, state, level=9, node=None, lineno=None, line=""):
-        call = inspect.stack()[1][3]
-        # this = inspect.stack()[0][3]
-        key = call.replace('visit_', '').lower()
-        val = PYTHON_ELEMENTS[key]
+        self.debug = pydebug.Debug(debuglevel, "DBG: %(line)s")
 
-        # handle STATE_ENTER
-        if state == self.STATE_ENTER:
-            self.state[key] = 1
+    @property
+    def tags(self):
+        return self.context.tags
 
-            if key == "functiondef":
-                self.state["func_enter"] = 1
+    @property
+    def result(self):
+        return self.context.result
 
-            if key == "classdef":
-                self.state["class_enter"] = 1
+    @property
+    def code(self):
+        return self.context.code
 
-        if state == self.STATE_EXIT and key == "functiondef":
-            self.state["func_exit"] = 1
+    @property
+    def error(self):
+        return self.context.error
 
-        if state == self.STATE_EXIT and key == "classdef":
-            self.state["class_exit"] = 1
+    @classmethod
+    def bind(cls, name):
+        '''
+        Look up the visitor for a node type name and derive its
+        PYTHON_ELEMENTS key from the visitor function name
+        '''
+        method = getattr(cls, 'visit_' + cls.ALIASES.get(name, name), None)
 
-            if self.has_func_exit:
-                self.state["func_exit"] = 1
+        if method is None:
+            return (cls.generic_visit, None)
 
-        if not lineno is None:
-            self.lineno = lineno
-        else:
-            lineno = -1
-            if node is None:
-                pass
-            elif hasattr(node, 'lineno'):
-                self.lineno = node.lineno -1
+        return (method, method.__name__.replace('visit_', '').lower())
 
-        nodetype=""
-        if not node is None:
-            nodetype=type(node)
+    @classmethod
+    def build_dispatch(cls):
+        '''
+        Build the node type -> visitor table once per class, for every node
+        type of the running python version
+        '''
+        cls.dispatch = {}
 
-        #
-        self.state[KEY_CLASS_COUNT] = self.in_classdef
-        self.state[KEY_FUNC_COUNT] = self.in_funcdef
+        types = [AST]
+        while types:
+            node_type = types.pop()
+            types.extend(node_type.__subclasses__())
 
-        #
-        flags = [key for key in self.state.keys() if PYTHON_ELEMENTS[key] == 1 or key in [ KEY_CLASS_COUNT, KEY_FUNC_COUNT ]]
+            cls.dispatch[node_type] = cls.bind(node_type.__name__)
 
-        if level <= self.debuglevel:
-            if  level > 8:
-                _stack=','.join(self.stack)
-                _flags=flags
-            else:
-                _stack=""
-                _flags=""
-            print("LOG: node=%-30s line=%-4d / %-4d s=%-6s v=%s k=%-20s f=%r stack=%s" % (
-                nodetype,
-                self.lineno, lineno, 
-                state, val, key, 
-                _flags,
-                _stack
-            ))
+        cls.constants = dict((value_type, cls.bind(name))
+                             for (value_type, name) in cls.CONSTANTS.items())
 
-        if val == 1:
-            self.lines[self.lineno] = flags
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
 
-        self.debug(8, "f=%r s=%r" % (flags, state))
+        # subclasses may override visitors, they get their own table
+        cls.build_dispatch()
 
-        # handle STATE_ENTER
-        if "func_enter" in self.state and key == "body":
-            del self.state["func_enter"]
+    def visit(self, node):
+        '''
+        Run the visitor for node with its element key bound
+        '''
+        entry = self.dispatch.get(node.__class__)
+        if entry is None:
+            entry = self.dispatch[node.__class__] = self.bind(node.__class__.__name__)
 
-        if "class_enter" in self.state and key == "body":
-            del self.state["class_enter"]
+        (method, key) = entry
 
-        # handle STATE_EXIT
-        if state == self.STATE_EXIT:
-            if "func_exit" in self.state:
-                del self.state["func_exit"]
+        outer = self.key
+        self.key = key
 
-                self.has_func_exit = True
+        try:
+            return method(self, node)
+        finally:
+            self.key = outer
 
-            if "class_exit" in self.state:
-                del self.state["class_exit"]
+    def visit_Constant(self, node):
+        '''
+        Python 3.8+ reports Str, Bytes, Num, NameConstant and Ellipsis as
+        Constant, run the visitor of the matching value type
+        '''
+        (method, key) = self.constants.get(type(node.value), self.constants[int])
 
-            if key in self.state:
-                del self.state[key]
+        outer = self.key
+        self.key = key
 
-        self.debug(8, "f=%r s=%r" % (flags, state))
+        try:
+            return method(self, node)
+        finally:
+            self.key = outer
+
+    def setstate(self, state, level=9, node=None, lineno=None, line=""):
+        '''
+        Trace a visitor entering or leaving its element at debug level
+        <level>. The line tags come from segment(), regenerating the source
+        keeps no state here.
+        '''
+        if level > self.debuglevel:
+            return
+
+        if lineno is None and node is not None and hasattr(node, 'lineno'):
+            lineno = node.lineno - 1
+
+        print("LOG: node=%-30s line=%-4d s=%-6s v=%s k=%-20s stack=%s %s" % (
+            type(node) if not node is None else "",
+            -1 if lineno is None else lineno,
+            state, PYTHON_ELEMENTS[self.key], self.key,
+            ','.join(self.context.stack), line
+        ))
 
     def push(self):
         '''
         -
         '''
-        call = inspect.stack()[1][3]
-        this = inspect.stack()[0][3]
-        key = call.replace('visit_', '').lower()
-
-        self.stack.append(key)
+        self.context.stack.append(self.key)
 
     def pop(self):
-        self.stack.pop()
+        self.context.stack.pop()
         
     def write(self, line, append_newline=False):
-        if self.new_lines:
-            if self.result:
-                self.result.append('\n' * self.new_lines)
+        context = self.context
+
+        if context.new_lines:
+            if context.result:
+                context.result.append('\n' * context.new_lines)
 
-            self.result.append(self.indent_with * self.indentation)
-            self.new_lines = 0
+            context.result.append(self.indent_with * context.indentation)
+            context.new_lines = 0
 
-        self.result.append(line)
+        context.result.append(line)
 
         if append_newline:
             self.newline()
 
     def newline(self, node=None, extra=0):
-        self.new_lines = max(self.new_lines, 1 + extra)
+        self.context.new_lines = max(self.context.new_lines, 1 + extra)
         if node is not None and self.add_line_information:
             self.write('# line: %s' % node.lineno)
-            self.new_lines = 1
+            self.context.new_lines = 1
 
+    @element("signature")
     def signature(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
@@ -290,20 +626,38 @@ class Parser(NodeVisitor):
             else:
                 want_comma.append(True)
 
-        padding = [None] * (len(node.args) - len(node.defaults))
-        for arg, default in zip(node.args, padding + node.defaults):
+        posonlyargs = getattr(node, 'posonlyargs', [])
+        args = posonlyargs + node.args
+
+        padding = [None] * (len(args) - len(node.defaults))
+        for idx, (arg, default) in enumerate(zip(args, padding + node.defaults)):
             write_comma()
             self.visit(arg)
             if default is not None:
                 self.write('=')
                 self.visit(default)
+            if idx + 1 == len(posonlyargs):
+                write_comma()
+                self.write('/')
         if node.vararg is not None:
             write_comma()
-            self.write('*' + node.vararg.arg)
+            self.write('*')
+            self.visit(node.vararg)
+        elif node.kwonlyargs:
+            write_comma()
+            self.write('*')
+        for arg, default in zip(node.kwonlyargs, node.kw_defaults):
+            write_comma()
+            self.visit(arg)
+            if default is not None:
+                self.write('=')
+                self.visit(default)
         if node.kwarg is not None:
             write_comma()
-            self.write('**' + node.kwarg.arg)
+            self.write('**')
+            self.visit(node.kwarg)
 
+    @element("decorators")
     def decorators(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
@@ -326,13 +680,22 @@ class Parser(NodeVisitor):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
         self.newline(node)
-        for idx, target in enumerate(node.targets):
-            if idx:
-                self.write(', ')
+        for target in node.targets:
             self.visit(target)
-        self.write(' = ')
+            self.write(' = ')
         self.visit(node.value)
 
+    def visit_AnnAssign(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.newline(node)
+        self.visit(node.target)
+        self.write(': ')
+        self.visit(node.annotation)
+        if node.value is not None:
+            self.write(' = ')
+            self.visit(node.value)
+
     def visit_AugAssign(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
@@ -346,11 +709,11 @@ class Parser(NodeVisitor):
         self.setstate(self.STATE_ENTER, 2, node=node)
 
         self.newline(node)
-        self.write('from %s%s import ' % ('.' * node.level, node.module))
+        self.write('from %s%s import ' % ('.' * node.level, node.module or ''))
         for idx, item in enumerate(node.names):
             if idx:
                 self.write(', ')
-            self.write(item)
+            self.visit(item)
 
         self.setstate(self.STATE_EXIT, 2, node=node)
         self.pop()
@@ -360,8 +723,10 @@ class Parser(NodeVisitor):
         self.setstate(self.STATE_ENTER, 2, node=node, line="IMPORT: ")
 
         self.newline(node)
-        for item in node.names:
-            self.write('import ')
+        self.write('import ')
+        for idx, item in enumerate(node.names):
+            if idx:
+                self.write(', ')
             self.visit(item)
 
         self.setstate(self.STATE_EXIT, 2, node=node, line="IMPORT: DONE")
@@ -371,34 +736,41 @@ class Parser(NodeVisitor):
         self.push()
         self.setstate(self.STATE_ENTER, node=node, line="EXPR: ")
 
-        self.generic_visit(node)
+        self.newline(node)
+        self.visit(node.value)
 
         self.setstate(self.STATE_ENTER, node=node, line="EXPR: DONE")
         self.pop()
 
     def visit_FunctionDef(self, node):
         self.push()
-        self.in_funcdef += 1
         self.setstate(self.STATE_ENTER, level=2, node=node)
 
         self.newline(extra=1)
         self.decorators(node)
         self.newline(node)
 
-        self.write('def %s(' % node.name)
+        if isinstance(node, AsyncFunctionDef):
+            self.write('async ')
+
+        self.write('def %s' % node.name)
+        self.type_params(node)
+        self.write('(')
         self.visit(node.args)
-        self.write('):')
+        self.write(')')
+        if node.returns is not None:
+            self.write(' -> ')
+            self.visit(node.returns)
+        self.write(':')
         self.body(node.body)
 
         self.newline()
 
-        self.setstate(self.STATE_EXIT, level=2, lineno=self.lineno)
-        self.in_funcdef -= 1
+        self.setstate(self.STATE_EXIT, level=2, node=node)
         self.pop()
         
     def visit_ClassDef(self, node):
         self.push()
-        self.in_classdef += 1
         self.setstate(self.STATE_ENTER, level=2, node=node)
 
         have_args = []
@@ -415,6 +787,7 @@ class Parser(NodeVisitor):
         self.newline(node)
 
         self.write('class %s' % node.name)
+        self.type_params(node)
 
         for base in node.bases:
             paren_or_comma()
@@ -423,8 +796,7 @@ class Parser(NodeVisitor):
         if hasattr(node, 'keywords'):
             for keyword in node.keywords:
                 paren_or_comma()
-                self.write(keyword.arg + '=')
-                self.visit(keyword.value)
+                self.visit(keyword)
 
             if not hasattr(node, 'starargs'):
                 pass
@@ -443,10 +815,10 @@ class Parser(NodeVisitor):
         self.write(have_args and '):' or ':')
         self.body(node.body)
 
-        self.setstate(self.STATE_EXIT, 2, node=node, lineno=self.lineno)
-        self.in_classdef -= 1
+        self.setstate(self.STATE_EXIT, 2, node=node)
         self.pop()
 
+    @element("body_or_else")
     def body_or_else(self, node):
         self.push()
         self.setstate(self.STATE_ENTER, node=node)
@@ -460,17 +832,18 @@ class Parser(NodeVisitor):
         self.setstate(self.STATE_EXIT)
         self.pop()
 
+    @element("body")
     def body(self, statements):
         self.push()
         self.setstate(self.STATE_ENTER)
 
         self.new_line = True
-        self.indentation += 1
+        self.context.indentation += 1
 
         for stmt in statements:
             self.visit(stmt)
 
-        self.indentation -= 1
+        self.context.indentation -= 1
 
         self.setstate(self.STATE_EXIT)
         self.pop()
@@ -504,6 +877,8 @@ class Parser(NodeVisitor):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
         self.newline(node)
+        if isinstance(node, AsyncFor):
+            self.write('async ')
         self.write('for ')
         self.visit(node.target)
         self.write(' in ')
@@ -524,6 +899,8 @@ class Parser(NodeVisitor):
         self.setstate(self.STATE_ENTER, node=node)
 
         self.newline(node)
+        if isinstance(node, AsyncWith):
+            self.write('async ')
         self.write('with ')
         if hasattr(node, 'context_expr'):
             self.visit(node.context_expr)
@@ -533,6 +910,11 @@ class Parser(NodeVisitor):
                 self.write(' as ')
                 self.visit(node.optional_vars)
 
+        for idx, item in enumerate(getattr(node, 'items', [])):
+            if idx:
+                self.write(', ')
+            self.visit(item)
+
         self.write(':')
         self.body(node.body)
 
@@ -566,17 +948,16 @@ class Parser(NodeVisitor):
     def visit_Delete(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
-        self.debug(2, "node%r" % node)
+        self.debug(2, "node%r", node)
 
         self.newline(node)
         self.write('del ')
 
-        r''' IGNORE
-        for idx, target in enumerate(node):
+        for idx, target in enumerate(node.targets):
             if idx:
                 self.write(', ')
             self.visit(target)
-        '''
+
     def visit_TryExcept(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
@@ -676,8 +1057,7 @@ class Parser(NodeVisitor):
             self.visit(arg)
         for keyword in node.keywords:
             write_comma()
-            self.write(keyword.arg + '=')
-            self.visit(keyword.value)
+            self.visit(keyword)
 
         if not hasattr(node, 'starargs'):
             pass
@@ -705,17 +1085,17 @@ class Parser(NodeVisitor):
     def visit_Str(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
-        self.write(repr(node.s))
+        self.write(repr(node.value))
 
     def visit_Bytes(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
-        self.write(repr(node.s))
+        self.write(repr(node.value))
 
     def visit_Num(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
-        self.write(repr(node.n))
+        self.write(repr(node.value))
 
     def visit_Tuple(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
@@ -751,17 +1131,22 @@ class Parser(NodeVisitor):
         for idx, (key, value) in enumerate(zip(node.keys, node.values)):
             if idx:
                 self.write(', ')
-            self.visit(key)
-            self.write(': ')
+            if key is None:
+                self.write('**')
+            else:
+                self.visit(key)
+                self.write(': ')
             self.visit(value)
         self.write('}')
 
     def visit_BinOp(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
+        self.write('(')
         self.visit(node.left)
         self.write(' %s ' % BINOP_SYMBOLS[type(node.op)])
         self.visit(node.right)
+        self.write(')')
 
     def visit_BoolOp(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
@@ -799,7 +1184,16 @@ class Parser(NodeVisitor):
 
         self.visit(node.value)
         self.write('[')
-        self.visit(node.slice)
+        if isinstance(node.slice, Tuple) and node.slice.elts:
+            # a[1:2, ...], slices are not allowed in parentheses
+            for idx, item in enumerate(node.slice.elts):
+                if idx:
+                    self.write(', ')
+                self.visit(item)
+            if len(node.slice.elts) == 1:
+                self.write(',')
+        else:
+            self.visit(node.slice)
         self.write(']')
 
     def visit_Slice(self, node):
@@ -831,23 +1225,27 @@ class Parser(NodeVisitor):
     def visit_Yield(self, node):
         self.setstate(self.STATE_ENTER, node=node)
 
-        self.write('yield ')
+        self.write('(yield')
 
         if node.value:
+            self.write(' ')
             self.visit(node.value)
 
+        self.write(')')
+
     def visit_Lambda(self, node):
         self.setstate(self.STATE_ENTER, node=node)
 
-        self.write('lambda ')
+        self.write('(lambda ')
         self.visit(node.args)
         self.write(': ')
         self.visit(node.body)
+        self.write(')')
 
     def visit_Ellipsis(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
-        self.write('Ellipsis')
+        self.write('...')
 
     def generator_visit(left, right):
         def visit(self, node):
@@ -879,11 +1277,13 @@ class Parser(NodeVisitor):
     def visit_IfExp(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
+        self.write('(')
         self.visit(node.body)
         self.write(' if ')
         self.visit(node.test)
         self.write(' else ')
         self.visit(node.orelse)
+        self.write(')')
 
     def visit_Starred(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
@@ -910,7 +1310,7 @@ class Parser(NodeVisitor):
     def visit_comprehension(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
-        self.write(' for ')
+        self.write(' async for ' if getattr(node, 'is_async', 0) else ' for ')
         self.visit(node.target)
         self.write(' in ')
         self.visit(node.iter)
@@ -923,41 +1323,774 @@ class Parser(NodeVisitor):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
         self.newline(node)
-        self.write('except')
+        self.write(self.except_keyword)
         if node.type is not None:
             self.write(' ')
             self.visit(node.type)
             if node.name is not None:
-                self.write(' as ')
-                self.visit(node.name)
+                self.write(' as ' + node.name)
+        self.write(':')
+        self.body(node.body)
+
+    def visit_Try(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.newline(node)
+        self.write('try:')
+        self.body(node.body)
+
+        # TryStar (python 3.11) only differs in the except clauses
+        outer = self.except_keyword
+        if not isinstance(node, Try):
+            self.except_keyword = 'except*'
+
+        try:
+            for handler in node.handlers:
+                self.visit(handler)
+        finally:
+            self.except_keyword = outer
+
+        if node.orelse:
+            self.newline()
+            self.write('else:')
+            self.body(node.orelse)
+        if node.finalbody:
+            self.newline()
+            self.write('finally:')
+            self.body(node.finalbody)
+
+    def visit_NameConstant(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write(repr(node.value))
+
+    def visit_Index(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        # python 3.8 only
+        self.visit(node.value)
+
+    def visit_keyword(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        if node.arg is None:
+            self.write('**')
+        else:
+            self.write(node.arg + '=')
+        self.visit(node.value)
+
+    def visit_arg(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write(node.arg)
+        if node.annotation is not None:
+            self.write(': ')
+            self.visit(node.annotation)
+
+    def visit_withitem(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.visit(node.context_expr)
+        if node.optional_vars is not None:
+            self.write(' as ')
+            self.visit(node.optional_vars)
+
+    def visit_Await(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('(await ')
+        self.visit(node.value)
+        self.write(')')
+
+    def visit_YieldFrom(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('(yield from ')
+        self.visit(node.value)
+        self.write(')')
+
+    def visit_NamedExpr(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('(')
+        self.visit(node.target)
+        self.write(' := ')
+        self.visit(node.value)
+        self.write(')')
+
+    def capture(self, node):
+        '''
+        Return the regenerated source of an expression
+        '''
+        context = self.context
+        (result, new_lines) = (context.result, context.new_lines)
+        (context.result, context.new_lines) = ([], 0)
+
+        self.visit(node)
+        text = ''.join(context.result)
+
+        (context.result, context.new_lines) = (result, new_lines)
+        return text
+
+    def fstring(self, node):
+        '''
+        Return the text between the quotes of an f-string
+        '''
+        text = []
+        for value in node.values:
+            if isinstance(value, Constant):
+                text.append(value.value.replace('{', '{{').replace('}', '}}'))
+                continue
+
+            # FormattedValue
+            expr = self.capture(value.value)
+            if expr[:1] == '{':
+                expr = ' ' + expr
+
+            text.append('{' + expr)
+            if value.conversion != -1:
+                text.append('!' + chr(value.conversion))
+            if value.format_spec is not None:
+                text.append(':' + self.fstring(value.format_spec))
+            text.append('}')
+
+        return ''.join(text)
+
+    def visit_JoinedStr(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('f' + repr(self.fstring(node)))
+
+    def visit_Match(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.newline(node)
+        self.write('match ')
+        self.visit(node.subject)
+        self.write(':')
+
+        self.context.indentation += 1
+        for case in node.cases:
+            self.visit(case)
+        self.context.indentation -= 1
+
+    def visit_match_case(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.newline()
+        self.write('case ')
+        self.visit(node.pattern)
+        if node.guard is not None:
+            self.write(' if ')
+            self.visit(node.guard)
         self.write(':')
         self.body(node.body)
 
+    def visit_MatchValue(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.visit(node.value)
+
+    def visit_MatchSingleton(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write(repr(node.value))
+
+    def visit_MatchSequence(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('[')
+        for idx, pattern in enumerate(node.patterns):
+            if idx:
+                self.write(', ')
+            self.visit(pattern)
+        self.write(']')
+
+    def visit_MatchMapping(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('{')
+        for idx, (key, pattern) in enumerate(zip(node.keys, node.patterns)):
+            if idx:
+                self.write(', ')
+            self.visit(key)
+            self.write(': ')
+            self.visit(pattern)
+        if node.rest is not None:
+            if node.keys:
+                self.write(', ')
+            self.write('**' + node.rest)
+        self.write('}')
+
+    def visit_MatchClass(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.visit(node.cls)
+        self.write('(')
+        for idx, pattern in enumerate(node.patterns):
+            if idx:
+                self.write(', ')
+            self.visit(pattern)
+        for idx, (attr, pattern) in enumerate(zip(node.kwd_attrs, node.kwd_patterns)):
+            if idx or node.patterns:
+                self.write(', ')
+            self.write(attr + '=')
+            self.visit(pattern)
+        self.write(')')
+
+    def visit_MatchStar(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('*' + (node.name or '_'))
+
+    def visit_MatchAs(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        if node.pattern is None:
+            self.write(node.name or '_')
+        else:
+            self.write('(')
+            self.visit(node.pattern)
+            self.write(' as ' + node.name + ')')
+
+    def visit_MatchOr(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('(')
+        for idx, pattern in enumerate(node.patterns):
+            if idx:
+                self.write(' | ')
+            self.visit(pattern)
+        self.write(')')
+
+    def type_params(self, node):
+        '''
+        Write the type parameters of a generic function, class or type alias
+        (python 3.12)
+        '''
+        params = getattr(node, 'type_params', None)
+        if not params:
+            return
+
+        self.write('[')
+        for idx, param in enumerate(params):
+            if idx:
+                self.write(', ')
+            self.visit(param)
+        self.write(']')
+
+    def visit_TypeAlias(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.newline(node)
+        self.write('type ')
+        self.visit(node.name)
+        self.type_params(node)
+        self.write(' = ')
+        self.visit(node.value)
+
+    def visit_TypeVar(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write(node.name)
+        if node.bound is not None:
+            self.write(': ')
+            self.visit(node.bound)
+        if getattr(node, 'default_value', None) is not None:
+            self.write(' = ')
+            self.visit(node.default_value)
+
+    def visit_ParamSpec(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('**' + node.name)
+        if getattr(node, 'default_value', None) is not None:
+            self.write(' = ')
+            self.visit(node.default_value)
+
+    def visit_TypeVarTuple(self, node):
+        self.setstate(self.STATE_ENTER, 4, node=node)
+
+        self.write('*' + node.name)
+        if getattr(node, 'default_value', None) is not None:
+            self.write(' = ')
+            self.visit(node.default_value)
+
     def visit_arguments(self, node):
         self.setstate(self.STATE_ENTER, 4, node=node)
 
         self.signature(node)
 
-    def parse(self, filename):
+    def parse(self, source):
+        '''
+        Parse a pysource.Source or a file name
+        '''
         self.debug(1)
 
-        ignoreLine=False
-        with open(filename) as f:
-            self.code = []
+        self.load(source)
+        tree = self.syntax_tree()
 
-            for line in f.readlines():
-                if line[0:2] == '#!':
-                    ignoreLine = True
-                elif ignoreLine and line.strip() == "":
-                    pass
-                else:
-                    self.code.append(line.rstrip())
-                    ignoreLine = False
+        if tree is None:
+            self.segment_tokens()
+            return
+
+        if self.regenerate:
+            self.generate(tree)
 
-        tree = ast.parse(os.linesep.join(self.code))
+        self.segment(tree)
+
+    def generate(self, tree):
+        '''
+        Regenerate the source of tree into result, the line tags come from
+        segment()
+        '''
         self.visit(tree)
+        self.context.allocate()
+
+    def parse_code(self, code):
+        '''
+        Return the ast of code text, the parser builds every ast here
+        '''
+        return parse_tree(code)
+
+    def load(self, source):
+        '''
+        Reset the context to the code of a pysource.Source or a file name
+        '''
+        if not isinstance(source, pysource.Source):
+            source = pysource.Source.read(source)
+
+        context = self.context
+        context.reset()
+
+        # the kept lines are shared with source
+        context.code.extend(skip_hashbang(source.lines, context.skipped))
+
+        context.allocate()
+
+    def chunks(self, lines):
+        '''
+        Yield (first line number, lines, ast) chunks of whole top-level
+        statements of code given as an iterable of lines without line
+        endings. Only the lines of the current chunk are kept.
+
+        A statement starts with code in column 0, unless the line continues
+        the statement before it (else, except, ...) or follows a decorator.
+        Such a line may also be within a string or brackets: a chunk is only
+        taken if it parses, else it grows to twice as many candidate
+        statements. Comments and blank lines go with the statement before
+        them. Parse errors of the last chunk raise.
+        '''
+        # lines read since the last chunk, the first one is line number base
+        buffer = []
+        base = 0
+
+        # candidate statements since the last try, and needed for the next
+        candidates = 0
+        wanted = 1
+
+        decorated = False
+
+        for line in lines:
+            if line[:1] not in STATEMENT_INDENT and buffer and not decorated \
+                    and not CLAUSE.match(line):
+                candidates += 1
+
+                if candidates >= wanted:
+                    try:
+                        tree = self.parse_code(os.linesep.join(buffer))
+                    except PARSE_ERRORS:
+                        wanted = candidates * 2
+                    else:
+                        yield (base, buffer, tree)
+
+                        base += len(buffer)
+                        buffer = []
+                        wanted = 1
+
+                    candidates = 0
+
+            if line[:1] == "@":
+                decorated = True
+            elif line[:1] not in STATEMENT_INDENT:
+                decorated = False
+
+            buffer.append(line)
+
+        if buffer:
+            yield (base, buffer, self.parse_code(os.linesep.join(buffer)))
+
+    def stream(self, lines):
+        '''
+        Yield the (line number, line, tag bitmask) rows of code given as an
+        iterable of lines without line endings, for notebook(rows).
+
+        The code is parsed and tagged a chunk of top-level statements at a
+        time, see chunks(), so memory is bounded by the largest statement
+        and not by the file. The rows are the same as for parse() of the
+        whole code. Parse errors raise, there is no fallback.
+        '''
+        self.debug(1)
+
+        context = self.context
+
+        for (base, code, tree) in self.chunks(skip_hashbang(lines)):
+            context.reset()
+            context.code = code
+            context.allocate()
+
+            self.segment(tree)
+
+            tags = context.tags
+            for (index, line) in enumerate(code):
+                yield (base + index, line, tags[index])
+
+    def segment(self, tree):
+        '''
+        Tag the source lines statement by statement.
+
+        Every statement tags its whole line range lineno..end_lineno, so the
+        cost depends on the number of statements, not on the expressions.
+        Class and function definitions mark their first line, including
+        decorators, with class/func_enter and their last line with
+        class/func_exit. Definitions nested in functions are part of the
+        enclosing function and not marked. Strings used as statements
+        (docstrings) are not tagged.
+        '''
+        self.debug(1)
+
+        context = self.context
+        tags = context.tags
+        classes = context.classes
+        funcs = context.funcs
+
+        counter = self.counter
+
+        # enter/exit bits, added after all ranges are tagged
+        marks = []
+
+        def statements(body, in_func):
+            '''
+            Return the (first line, statement) pairs of a block, definitions
+            outside functions start at their first decorator
+            '''
+            lines = []
+
+            for node in body:
+                first = node.lineno - 1
+
+                if not in_func and type(node) in DEFINITIONS and node.decorator_list:
+                    first = min(first, node.decorator_list[0].lineno - 1)
+
+                lines.append((first, node))
+
+            return lines
+
+        # explicit stack of (statement iterator, class depth, function
+        # depth): one entry per open block, no python frame per nesting
+        # level, the statements are tagged in source order
+        stack = [(iter(statements(tree.body, 0)), 0, 0)]
+
+        while stack:
+            (body, in_class, in_func) = stack[-1]
+
+            (start, node) = next(body, (None, None))
+            if node is None:
+                stack.pop()
+                continue
+
+            end = node.end_lineno
+
+            kind = type(node)
+            tag = TAG_LINE | STATEMENT_TAGS.get(kind, 0)
+
+            if counter is not None:
+                counter(kind.__name__)
+
+            if kind is Expr and isinstance(node.value, Constant) and isinstance(node.value.value, str):
+                tag = 0
+
+            enter = 0
+            exit = 0
+            nested_class = in_class
+            nested_func = in_func
+
+            if kind is ClassDef:
+                nested_class += 1
+                if not in_func:
+                    (enter, exit) = (CLASS_ENTER, CLASS_EXIT)
+            elif kind is FunctionDef or kind is AsyncFunctionDef:
+                nested_func += 1
+                if not in_func:
+                    (enter, exit) = (FUNC_ENTER, FUNC_EXIT)
+
+            if enter:
+                marks.append((start, enter))
+                marks.append((end - 1, exit))
+
+            fields = BLOCK_FIELDS.get(kind)
+
+            if fields is None:
+                count = end - start
+                tags[start:end] = array('I', [tag]) * count
+                classes[start:end] = array('H', [nested_class]) * count
+                funcs[start:end] = array('H', [nested_func]) * count
+                continue
+
+            # except handlers are tagged like statements, match cases have
+            # no line numbers of their own
+            blocks = []
+            for field in fields:
+                children = getattr(node, field)
+                if field == "cases":
+                    blocks.extend(statements(case.body, nested_func) for case in children)
+                elif children:
+                    blocks.append(statements(children, nested_func))
+
+            # the nested statements tag their own lines, only the remaining
+            # lines (header, else:, comments) are tagged here. Tagging the
+            # whole range would be quadratic for an elif ladder.
+            for lines in blocks + [[(end, None)]]:
+                for (first, child) in lines:
+                    if first > start:
+                        count = first - start
+                        tags[start:first] = array('I', [tag]) * count
+                        classes[start:first] = array('H', [nested_class]) * count
+                        funcs[start:first] = array('H', [nested_func]) * count
+
+                    if child is not None and child.end_lineno > start:
+                        start = child.end_lineno
+
+            # pushed in reverse, so the blocks are walked in source order
+            for lines in reversed(blocks):
+                stack.append((iter(lines), nested_class, nested_func))
+
+        for (lineno, bit) in marks:
+            tags[lineno] |= bit | TAG_LINE
+
+    def segment_tokens(self):
+        '''
+        Tag the source lines from the tokens, for code that does not parse
+        (python 2, templates).
+
+        Logical lines are tagged like the statements of segment(), by their
+        first keyword. A line ending with ':' opens the block of the
+        following indented lines, so the comments and blank lines within
+        a block get the tag of its header. Class and function definitions
+        are marked with enter/exit like in segment(). If the tokenizer
+        gives up, the remaining lines are code.
+        '''
+        self.debug(1)
+
+        context = self.context
+        tags = context.tags
+        classes = context.classes
+        funcs = context.funcs
+
+        def fill(start, end, tag, in_class, in_func):
+            count = end - start
+            if count > 0:
+                tags[start:end] = array('I', [tag]) * count
+                classes[start:end] = array('H', [in_class]) * count
+                funcs[start:end] = array('H', [in_func]) * count
+
+        counter = self.counter
+
+        marks = []
+
+        # open blocks as (header tag, class depth, function depth, exit bit)
+        blocks = [(0, 0, 0, 0)]
+
+        # the block a line ending with ':' opens if an indent follows, and
+        # the last line of that header
+        opener = None
+        opener_end = 0
+
+        # significant tokens of the current logical line
+        line = []
+
+        # end of the last logical line, first line of pending decorators
+        last = 0
+        decorated = None
+
+        # the block closed last, continued by else/except/... clauses
+        closed = None
+
+        readline = io.StringIO('\n'.join(context.code) + '\n').readline
+
+        try:
+            for token in tokenize.generate_tokens(readline):
+                kind = token.type
+
+                if kind == tokenize.INDENT:
+                    blocks.append(opener or blocks[-1][:3] + (0,))
+                    opener = None
+                    continue
+
+                if kind == tokenize.DEDENT:
+                    closed = blocks.pop()
+                    if closed[3]:
+                        marks.append((last - 1, closed[3]))
+                    continue
+
+                if kind in (tokenize.NL, tokenize.COMMENT, tokenize.ENCODING):
+                    continue
+
+                if kind != tokenize.NEWLINE and kind != tokenize.ENDMARKER:
+                    if not line:
+                        # a header without an indented block closes at once
+                        if opener is not None and opener[3]:
+                            marks.append((opener_end, opener[3]))
+                        opener = None
+
+                        # comments and blank lines belong to the block of
+                        # the next line, or to the compound statement it
+                        # continues
+                        if token.string not in CLAUSES or closed is None:
+                            closed = None
+                            (tag, in_class, in_func, _) = blocks[-1]
+                        else:
+                            (tag, in_class, in_func, _) = closed
+                        fill(last, token.start[0] - 1, tag, in_class, in_func)
+
+                    line.append(token)
+                    continue
+
+                if not line:
+                    continue
+
+                (start, end) = (line[0].start[0] - 1, token.start[0])
+                (_, in_class, in_func, _) = blocks[-1]
+
+                word = line[0].string
+                if word == "async" and len(line) > 1:
+                    word = line[1].string
+
+                keyword = line[0].type == tokenize.NAME and \
+                    not (len(line) > 1 and line[1].string == "=")
+
+                if line[0].type == tokenize.STRING and \
+                        all(item.type == tokenize.STRING for item in line):
+                    tag = 0
+                elif closed is not None:
+                    tag = closed[0]
+                elif keyword and word in KEYWORD_TAGS and \
+                        not (word == "print" and len(line) > 1 and line[1].string == "("):
+                    tag = TAG_LINE | KEYWORD_TAGS[word]
+                elif keyword and word in STATEMENT_KEYWORDS and \
+                        (word not in ("match", "case") or line[-1].string == ":"):
+                    tag = TAG_LINE
+                else:
+                    # the first operator outside brackets tells assignments
+                    # from expressions
+                    depth = 0
+                    operator = None
+                    for item in line:
+                        if item.type == tokenize.OP:
+                            if item.string in "([{":
+                                depth += 1
+                            elif item.string in ")]}":
+                                depth -= 1
+                            elif depth == 0 and item.string[-1] in "=:" and \
+                                    item.string not in ("==", "!=", "<=", ">=", ":="):
+                                operator = item.string
+                                break
+
+                    tag = TAG_LINE | (TAGS["assign"] if operator == "=" else
+                                      TAGS["expr"] if operator is None else 0)
+
+                if counter is not None:
+                    if word == "@" or keyword and (word in KEYWORD_TAGS or
+                                                   word in STATEMENT_KEYWORDS):
+                        counter("token " + word)
+                    else:
+                        names = tag_names(tag)
+                        counter("token " + (names[0] if names else
+                                            "string" if tag == 0 else "statement"))
+
+                if word == "@":
+                    if decorated is None:
+                        decorated = start
+                    fill(start, end, tag, in_class, in_func)
+                    (line, last) = ([], end)
+                    continue
+
+                enter = 0
+                exit = 0
+
+                if word == "class":
+                    in_class += 1
+                    if not in_func:
+                        (enter, exit) = (CLASS_ENTER, CLASS_EXIT)
+                elif word == "def":
+                    in_func += 1
+                    if not blocks[-1][2]:
+                        (enter, exit) = (FUNC_ENTER, FUNC_EXIT)
+
+                # definitions outside functions start at their decorators
+                if word in ("class", "def") and decorated is not None and \
+                        not blocks[-1][2]:
+                    start = decorated
+                decorated = None
+
+                if enter:
+                    marks.append((start, enter))
+
+                fill(start, end, tag, in_class, in_func)
+
+                if line[-1].type == tokenize.OP and line[-1].string == ":":
+                    opener = closed or (tag, in_class, in_func, exit)
+                    opener_end = end - 1
+                elif exit:
+                    marks.append((end - 1, exit))
+
+                (line, last, closed) = ([], end, None)
+
+        except (tokenize.TokenError, SyntaxError) as err:
+            self.debug(1, "tokenize: %s", err)
+
+            # the rest is code of the innermost block, open definitions
+            # end with the code
+            (_, in_class, in_func, _) = blocks[-1]
+            size = len(context.code)
+            fill(last, size, TAG_LINE, in_class, in_func)
+
+            for (_, _, _, exit) in blocks + [opener or (0, 0, 0, 0)]:
+                if exit and size:
+                    marks.append((size - 1, exit))
+
+        else:
+            if opener is not None and opener[3]:
+                marks.append((opener_end, opener[3]))
+
+        for (lineno, bit) in marks:
+            tags[lineno] |= bit | TAG_LINE
+
+    def syntax_tree(self):
+        '''
+        Return the ast of the loaded code. With fallback set, code that
+        does not parse returns None and keeps the error in self.error. The
+        error has the line numbers of the source, hashbang lines included.
+        '''
+        try:
+            return self.parse_code(os.linesep.join(self.context.code))
+        except PARSE_ERRORS as err:
+            self.context.locate(err)
 
-    def notebook(self):
+            if not self.fallback:
+                raise
+
+            self.debug(1, "parse error: %s", err)
+            self.context.error = err
+
+            return None
+
+    def notebook(self, rows=None):
+        '''
+        Yield the (line number, line, change, cell type) of the parsed code,
+        or of the (line number, line, tag bitmask) rows of stream(), None
+        ends the notebook
+        '''
         self.debug(1)
 
         currCx=0
@@ -968,34 +2101,36 @@ class Parser(NodeVisitor):
 
         lastType="M"
 
-        for lineno,line in enumerate(self.code):
-            tags=""
+        context = self.context
+
+        if rows is None:
+            rows = zip(range(len(context.code)), context.code, context.tags)
+
+        for (lineno, line, flags) in rows:
             inClass="__"
             inFunc="__"
             currType="M"
 
-            if lineno in self.lines:
-                tags = self.lines[lineno]
-
+            if flags & TAG_LINE:
                 if line.strip() in ["'''", '"""']:
                     currType="M"
                 else:
                     currType="C"
 
-            if "class_enter" in tags:
+            if flags & CLASS_ENTER:
                 inClass="C+"
-            elif "class_exit" in tags:
+            elif flags & CLASS_EXIT:
                 inClass="C-"
 
-            if "func_enter" in tags:
+            if flags & FUNC_ENTER:
                 inFunc="F+"
-            elif "func_exit" in tags:
+            elif flags & FUNC_EXIT:
                 inFunc="F-"
 
-            if "class_enter" in tags:
+            if flags & CLASS_ENTER:
                 currCx += 1
 
-            if "func_enter" in tags:
+            if flags & FUNC_ENTER:
                 currFx += 1
 
             if currCx > 0 or currFx > 0:
@@ -1012,10 +2147,10 @@ class Parser(NodeVisitor):
 
             yield (lineno, line, change, currType)
 
-            if "class_exit" in tags:
+            if flags & CLASS_EXIT:
                 currCx -= 1
 
-            if "func_exit" in tags:
+            if flags & FUNC_EXIT:
                 currFx -= 1
 
             lastCx = currCx
@@ -1023,3 +2158,6 @@ class Parser(NodeVisitor):
             lastType = currType
 
         yield None
+
+
+Parser.build_dispatch()
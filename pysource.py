@@ -0,0 +1,109 @@
+"""
+    Source
+    ~~~~~~
+
+    Source file ingestion shared by the parser, the --details printer and
+    the notebook emitter.
+
+    The file is read once as bytes and decoded with the encoding declared
+    by its PEP 263 coding cookie or BOM (utf-8 by default). Source text that
+    is already decoded is used as is.
+
+    Files too large to hold are read line by line with Stream, the lines
+    are the same.
+
+    :license: BSD.
+"""
+
+import io
+import os
+import codecs
+import hashlib
+import tokenize
+
+
+def split_lines(text):
+    '''
+    Return the lines of text without line ending and trailing blanks, \r\n
+    \r and \n end a line like the universal newlines of readlines()
+    '''
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+    lines = [line.rstrip() for line in text.split('\n')]
+    if text[-1:] in ('\n', ''):
+        lines.pop()
+
+    return lines
+
+
+class Source():
+
+    def __init__(self, data, filename="<string>"):
+        self.filename = filename
+
+        if isinstance(data, str):
+            self.encoding = None
+            text = data
+            data = text.encode('utf-8')
+        else:
+            (self.encoding, _) = tokenize.detect_encoding(io.BytesIO(data).readline)
+            text = data.decode(self.encoding)
+
+        self.data = data
+
+        # os.stat_result of the file taken before it was read, see read()
+        self.stat = None
+
+        # line index: the lines without line ending and trailing blanks,
+        # like readlines() + rstrip() in text mode
+        self.lines = split_lines(text)
+
+    @classmethod
+    def read(cls, filename):
+        '''
+        Read a source file with a single read
+        '''
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            source = cls(f.read(), filename)
+
+        source.stat = stat
+
+        return source
+
+
+class Stream():
+    '''
+    Source file read line by line: lines() yields the lines of Source.lines
+    without keeping them, digest hashes the content read so far and stat is
+    taken when the file is opened
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.encoding = None
+        self.digest = hashlib.sha256()
+        self.stat = None
+
+    def lines(self):
+        with open(self.filename, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+
+            (self.encoding, _) = tokenize.detect_encoding(f.readline)
+            f.seek(0)
+
+            decoder = codecs.getincrementaldecoder(self.encoding)()
+
+            # read at \n, a line with a \r in it is split like Source
+            # does, \r\n never spans two reads
+            for data in f:
+                self.digest.update(data)
+                text = decoder.decode(data)
+
+                if '\r' in text:
+                    yield from split_lines(text)
+                else:
+                    yield text.rstrip()
+
+            decoder.decode(b'', final=True)
@@ -0,0 +1,70 @@
+import os
+from collections import OrderedDict as odict
+
+
+@staticmethod
+def annotated(a: int, /, b: str = "b", *args, c=None, d: float = 1.0, **kwargs) -> dict:
+    total: int = 0
+    count: int
+    if (n := len(args)) > 1:
+        total += n
+    label = f"{a!r:>10} and {b} {{literal}} {kwargs['key']}"
+    merged = {**kwargs, 'a': a}
+    matrix = a @ b
+    return dict(total=total, label=label, **merged)
+
+
+async def fetch(session, urls):
+    async with session.get(urls[0]) as response, session.get(urls[1]):
+        data = await response.read()
+    async for item in session.stream():
+        yield item
+    result = [x async for x in session.stream() if x]
+    return
+
+
+def generator(values):
+    yield from values
+    del values[0], values[1:2]
+    lookup = values[1:2, ...]
+
+
+class Base:
+    pass
+
+
+class Derived(Base, metaclass=type):
+    '''
+    Docstring
+    '''
+
+    value = True
+
+    def method(self):
+        global counter
+        try:
+            counter = None
+        except (KeyError, ValueError) as err:
+            raise RuntimeError("failed") from err
+        except Exception:
+            pass
+        else:
+            counter = -1
+        finally:
+            counter = not counter
+
+        for index in range(10):
+            if index < 2:
+                continue
+            elif index > 8:
+                break
+        else:
+            pass
+
+        while counter:
+            counter = lambda x, *y, **z: (x, y, z)
+
+        with open(os.devnull) as f:
+            assert f, "closed"
+
+        return {k: v for k, v in zip('ab', b'ab')}, {1, 2}, (1,), [1j, 1.5, ...]
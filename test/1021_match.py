@@ -0,0 +1,16 @@
+def classify(command):
+    match command:
+        case [x, y, *rest]:
+            return x
+        case {"action": action, **rest}:
+            return action
+        case Point(x=0, y=0) | Point(1, 2):
+            return "origin"
+        case str() as text if text:
+            return text
+        case None | True:
+            return None
+        case 1 | -2 | "three":
+            return command
+        case _:
+            return 0